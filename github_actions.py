@@ -2,21 +2,1029 @@
 """
 Ansible callback plugin for GitHub Actions-compatible output.
 Groups output by play and task using ::group:: and ::endgroup:: markers.
+
+Ansible hooks are translated once into small immutable event records which
+are rendered as GitHub Actions output by the callback itself and dispatched
+to event sinks: the analysers behind the live annotations and summary
+sections, and the optional JSON lines and metrics outputs.
 """
+
+from ansible import context
 from ansible.plugins.callback import CallbackBase
+from collections import OrderedDict, deque, namedtuple
+import bisect
+import hashlib
+import heapq
+import json
 import os
+import statistics
+import time
+import zlib
+
+import yaml
 
 CALLBACK_VERSION = "2.0"
 CALLBACK_TYPE = "stdout"
 CALLBACK_NAME = "github_actions"
 
-# Default configuration options
+DOCUMENTATION = r"""
+name: github_actions
+type: stdout
+short_description: GitHub Actions-compatible output
+description:
+  - Groups output by play and task using GitHub Actions workflow commands
+    and marks results with notice, warning and error annotations.
+requirements:
+  - Set as the stdout callback in configuration.
+options:
+  verbose:
+    description: Show error details, stderr and grouping decisions.
+    type: bool
+    default: false
+    env:
+      - name: GITHUB_ACTIONS_VERBOSE
+    ini:
+      - section: callback_github_actions
+        key: verbose
+  archive_file:
+    description:
+      - File the output is streamed to as it is rendered, disabled when empty.
+    type: str
+    default: ansible-github-actions.log
+    env:
+      - name: GITHUB_ACTIONS_ARCHIVE_FILE
+    ini:
+      - section: callback_github_actions
+        key: archive_file
+  grouping:
+    description:
+      - Group output by C(play), by C(task), or C(smart) (play grouping for
+        one host, task grouping for several).
+    type: str
+    default: smart
+    env:
+      - name: GITHUB_ACTIONS_GROUPING
+    ini:
+      - section: callback_github_actions
+        key: grouping
+  json_file:
+    description: Stream every event to this file as JSON lines, disabled when unset.
+    type: str
+    env:
+      - name: GITHUB_ACTIONS_JSON_FILE
+    ini:
+      - section: callback_github_actions
+        key: json_file
+  metrics_file:
+    description: Write aggregated run metrics to this file as JSON, disabled when unset.
+    type: str
+    env:
+      - name: GITHUB_ACTIONS_METRICS_FILE
+    ini:
+      - section: callback_github_actions
+        key: metrics_file
+  output_limit:
+    description: Maximum characters kept from msg, stdout and stderr (0 = unlimited).
+    type: int
+    default: 1024
+    env:
+      - name: GITHUB_ACTIONS_OUTPUT_LIMIT
+    ini:
+      - section: callback_github_actions
+        key: output_limit
+  diff_lines:
+    description: Maximum lines shown per unique diff (0 = unlimited).
+    type: int
+    default: 50
+    env:
+      - name: GITHUB_ACTIONS_DIFF_LINES
+    ini:
+      - section: callback_github_actions
+        key: diff_lines
+  fail_threshold:
+    description:
+      - Failure rate (0-1) of a task or play that triggers an early warning
+        (0 = off).
+    type: float
+    default: 0.0
+    env:
+      - name: GITHUB_ACTIONS_FAIL_THRESHOLD
+    ini:
+      - section: callback_github_actions
+        key: fail_threshold
+  fail_min_hosts:
+    description: Results needed before a failure rate is checked.
+    type: int
+    default: 10
+    env:
+      - name: GITHUB_ACTIONS_FAIL_MIN_HOSTS
+    ini:
+      - section: callback_github_actions
+        key: fail_min_hosts
+  fail_marker_file:
+    description: File written as JSON when the failure threshold is crossed.
+    type: str
+    env:
+      - name: GITHUB_ACTIONS_FAIL_MARKER_FILE
+    ini:
+      - section: callback_github_actions
+        key: fail_marker_file
+  retry_file:
+    description: File listing unreachable hosts, one per line, for C(--limit @file).
+    type: str
+    env:
+      - name: GITHUB_ACTIONS_RETRY_FILE
+    ini:
+      - section: callback_github_actions
+        key: retry_file
+  straggler_factor:
+    description: Flag hosts slower than this multiple of the task median (0 = off).
+    type: float
+    default: 3.0
+    env:
+      - name: GITHUB_ACTIONS_STRAGGLER_FACTOR
+    ini:
+      - section: callback_github_actions
+        key: straggler_factor
+  straggler_min_hosts:
+    description: Results needed in a task before stragglers are flagged.
+    type: int
+    default: 5
+    env:
+      - name: GITHUB_ACTIONS_STRAGGLER_MIN_HOSTS
+    ini:
+      - section: callback_github_actions
+        key: straggler_min_hosts
+  sample_rate:
+    description: Share of hosts (0-1) whose ok and skipped lines are shown.
+    type: float
+    default: 1.0
+    env:
+      - name: GITHUB_ACTIONS_SAMPLE_RATE
+    ini:
+      - section: callback_github_actions
+        key: sample_rate
+  context_lines:
+    description: Recent results kept per host and shown after a failure (0 = off).
+    type: int
+    default: 10
+    env:
+      - name: GITHUB_ACTIONS_CONTEXT_LINES
+    ini:
+      - section: callback_github_actions
+        key: context_lines
+  context_hosts:
+    description:
+      - Maximum hosts with kept context, the least recently active is evicted
+        first.
+    type: int
+    default: 1000
+    env:
+      - name: GITHUB_ACTIONS_CONTEXT_HOSTS
+    ini:
+      - section: callback_github_actions
+        key: context_hosts
+"""
+
+# Default configuration options, taken from DOCUMENTATION so they are only
+# declared once
 DEFAULT_CONFIG = {
-    "verbose": False,
-    "archive_file": "ansible-github-actions.log",
-    "grouping": "smart",  # smart, play, task
+    name: spec.get("default")
+    for name, spec in yaml.safe_load(DOCUMENTATION)["options"].items()
 }
 
+# Attributes that differ from the name of the option they hold
+OPTION_ATTRIBUTES = {"grouping": "grouping_mode"}
+
+# Maximum number of host names listed for a deduplicated diff
+DIFF_HOSTS_SHOWN = 20
+
+# Number of slowest tasks listed in the summary
+SLOWEST_TASKS_SHOWN = 10
+
+# Number of roles and task files listed in the summary rollup
+ROLLUP_SHOWN = 15
+
+# Stragglers must also be at least this many seconds slower than the median
+STRAGGLER_MIN_SECONDS = 1.0
+
+# Results that did not run the task on the host, ignored for stragglers
+STRAGGLER_IGNORED_STATUSES = frozenset(("skipped", "unreachable"))
+
+# Number of stragglers kept and listed in the summary, worst first
+STRAGGLERS_SHOWN = 20
+
+# Characters of a failure message kept in a host's context
+CONTEXT_MSG_CHARS = 200
+
+# Failing hosts per task whose context is shown, later ones are only counted
+CONTEXT_HOSTS_SHOWN = 5
+
+# Number of slowest fact gathering hosts listed in the summary
+FACT_HOSTS_SHOWN = 5
+
+# Module names that gather facts
+FACT_GATHERING_ACTIONS = frozenset(
+    (
+        "gather_facts",
+        "setup",
+        "ansible.builtin.gather_facts",
+        "ansible.builtin.setup",
+        "ansible.legacy.gather_facts",
+        "ansible.legacy.setup",
+    )
+)
+
+# Number of example hosts listed per unreachable category
+UNREACHABLE_HOSTS_SHOWN = 5
+
+# Connection failure categories, matched in order against the lowercased msg
+UNREACHABLE_CATEGORIES = (
+    (
+        "dns",
+        (
+            "could not resolve hostname",
+            "name or service not known",
+            "nodename nor servname",
+            "temporary failure in name resolution",
+        ),
+    ),
+    (
+        "host_key",
+        (
+            "host key verification failed",
+            "remote host identification has changed",
+        ),
+    ),
+    (
+        "auth",
+        (
+            "permission denied",
+            "authentication failed",
+            "too many authentication failures",
+            "incorrect password",
+            "invalid password",
+        ),
+    ),
+    ("refused", ("connection refused",)),
+    ("timeout", ("timed out", "timeout")),
+    (
+        "network",
+        (
+            "no route to host",
+            "network is unreachable",
+            "connection reset",
+            "connection closed",
+        ),
+    ),
+)
+
+
+def _truncate(value, limit):
+    """Return value as a string of at most limit characters (0 = unlimited)."""
+    if value is None:
+        return ""
+    if not isinstance(value, str):
+        value = str(value)
+    if limit and len(value) > limit:
+        return value[:limit] + f"... [truncated {len(value) - limit} chars]"
+    return value
+
+
+class PlayStartEvent(namedtuple("PlayStartEvent", ["play", "timestamp"])):
+    """A play has started."""
+
+    __slots__ = ()
+    kind = "play_start"
+
+
+class TaskStartEvent(
+    namedtuple(
+        "TaskStartEvent",
+        [
+            "task",
+            "task_id",
+            "path",
+            "role",
+            "action",
+            "play",
+            "handler",
+            "check_mode",
+            "timestamp",
+        ],
+    )
+):
+    """A task or handler has started."""
+
+    __slots__ = ()
+    kind = "task_start"
+
+
+class TaskEndEvent(
+    namedtuple("TaskEndEvent", ["task", "task_id", "play", "duration", "timestamp"])
+):
+    """A task or handler has finished on all hosts."""
+
+    __slots__ = ()
+    kind = "task_end"
+
+
+class ResultEvent(
+    namedtuple(
+        "ResultEvent",
+        [
+            "status",
+            "host",
+            "play",
+            "task",
+            "task_id",
+            "path",
+            "changed",
+            "msg",
+            "rc",
+            "stdout",
+            "stderr",
+            "duration",
+            "elapsed",
+            "ignore_errors",
+            "timestamp",
+        ],
+    )
+):
+    """A single host result for a task.
+
+    Only the fields the plugin needs are copied out of the Ansible result;
+    the result object and its payload are never referenced by the event.
+    ``duration`` is the host's own run time, from the moment it started the
+    task; ``elapsed`` is the time since the task started, which also covers
+    waiting for a fork.
+    """
+
+    __slots__ = ()
+    kind = "result"
+
+
+class IncludeEvent(namedtuple("IncludeEvent", ["path", "hosts", "play", "timestamp"])):
+    """A task file was included for a set of hosts."""
+
+    __slots__ = ()
+    kind = "include"
+
+
+class PlayNoticeEvent(namedtuple("PlayNoticeEvent", ["reason", "play", "timestamp"])):
+    """A play could not run on any host (no_hosts_matched/no_hosts_remaining)."""
+
+    __slots__ = ()
+    kind = "play_notice"
+
+
+class DiffEvent(
+    namedtuple(
+        "DiffEvent",
+        ["host", "play", "task", "digest", "lines", "omitted", "timestamp"],
+    )
+):
+    """A file diff reported for a host.
+
+    ``lines`` holds at most ``diff_lines`` lines of the unified diff and is
+    shared between all events with the same ``digest``.
+    """
+
+    __slots__ = ()
+    kind = "diff"
+
+
+class StatsEvent(
+    namedtuple(
+        "StatsEvent",
+        [
+            "totals",
+            "plays",
+            "tasks",
+            "rollup",
+            "facts",
+            "unreachable",
+            "timestamp",
+        ],
+    )
+):
+    """The playbook has finished and final statistics are available."""
+
+    __slots__ = ()
+    kind = "stats"
+
+
+class EventSink(object):
+    """Base class for consumers of callback events.
+
+    ``handle`` may return lines to show immediately and ``summary`` returns
+    lines for the summary statistics; sinks that only record or export
+    events return nothing from either.
+    """
+
+    name = "sink"
+
+    def handle(self, event):
+        """Process a single event, optionally returning lines to show."""
+
+    def summary(self):
+        """Return lines for the summary statistics at the end of the run."""
+        return []
+
+    def close(self):
+        """Flush and release any resources at the end of the run."""
+
+
+class JsonLinesSink(EventSink):
+    """Stream every event to a file as one JSON object per line."""
+
+    name = "json"
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def handle(self, event):
+        if self._file is None:
+            self._file = open(self.path, "w", encoding="utf-8")
+        record = {"event": event.kind}
+        record.update(event._asdict())
+        self._file.write(json.dumps(record, default=str) + "\n")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class MetricsSink(EventSink):
+    """Aggregate event counts and run timing, written as JSON on close."""
+
+    name = "metrics"
+
+    def __init__(self, path):
+        self.path = path
+        self.events = {}
+        self.results = {}
+        self.rollup = {}
+        self.started = None
+        self.finished = None
+
+    def handle(self, event):
+        self.events[event.kind] = self.events.get(event.kind, 0) + 1
+        if event.kind == "result":
+            self.results[event.status] = self.results.get(event.status, 0) + 1
+        elif event.kind == "stats":
+            self.rollup = event.rollup
+        if self.started is None:
+            self.started = event.timestamp
+        self.finished = event.timestamp
+
+    def close(self):
+        metrics = {
+            "events": self.events,
+            "results": self.results,
+            "rollup": self.rollup,
+            "duration": (
+                round(self.finished - self.started, 3)
+                if self.started is not None
+                else 0.0
+            ),
+        }
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(metrics, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+
+class ArchiveSink(EventSink):
+    """Stream the rendered output lines to a file.
+
+    The archive receives the lines shown on stdout through ``write`` rather
+    than events, so the output of a run is never held in memory.
+    """
+
+    name = "archive"
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def write(self, line):
+        """Append a rendered line to the archive."""
+        if self._file is None:
+            self._file = open(self.path, "w", encoding="utf-8")
+        self._file.write(line + "\n")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class FailureRateMonitor(EventSink):
+    """Track rolling failure rates per task and per play.
+
+    ``observe`` returns a breach description the first time the failure rate
+    of a task or play reaches ``threshold``; later calls return None. The
+    breach is announced once and written to ``marker_file`` if one is set.
+    """
+
+    name = "failures"
+
+    def __init__(self, threshold, min_hosts, marker_file=None):
+        self.threshold = threshold
+        self.min_hosts = max(int(min_hosts or 1), 1)
+        self.marker_file = marker_file
+        self.tasks = {}  # task id -> [results, failures]
+        self.plays = {}  # play name -> (hosts seen, failed hosts)
+        self.breach = None
+
+    def handle(self, event):
+        if event.kind != "result":
+            return None
+        failed = event.status in ("failed", "unreachable") and not event.ignore_errors
+        breach = self.observe(event, failed)
+        if breach is None:
+            return None
+
+        lines = [
+            f"::error::Early failure warning: {breach['scope']} '{breach['name']}' "
+            f"failed on {breach['failures']}/{breach['total']} hosts "
+            f"({breach['rate']:.0%}, threshold {breach['threshold']:.0%})"
+        ]
+        if self.marker_file:
+            try:
+                with open(self.marker_file, "w", encoding="utf-8") as f:
+                    json.dump(breach, f, indent=2, sort_keys=True)
+                    f.write("\n")
+            except Exception as e:
+                lines.append(
+                    f"::notice::Failed to write failure marker "
+                    f"{self.marker_file}: {str(e)}"
+                )
+        return lines
+
+    def summary(self):
+        if self.breach is None:
+            return []
+        breach = self.breach
+        return [
+            f"\nEarly failure warning: {breach['scope']} '{breach['name']}' reached "
+            f"{breach['rate']:.0%} failures (threshold {breach['threshold']:.0%})"
+        ]
+
+    def observe(self, event, failed):
+        """Record a result and check the task and play failure rates."""
+        if not self.threshold or self.breach is not None:
+            return None
+
+        task_counts = self.tasks.setdefault(event.task_id or event.task, [0, 0])
+        task_counts[0] += 1
+        seen, failed_hosts = self.plays.setdefault(event.play, (set(), set()))
+        seen.add(event.host)
+        if failed:
+            task_counts[1] += 1
+            failed_hosts.add(event.host)
+
+        # Check on every result: failures that arrive before min_hosts results
+        # still count once later ok results push the total past it
+        scopes = (
+            ("task", event.task, task_counts[1], task_counts[0]),
+            ("play", event.play, len(failed_hosts), len(seen)),
+        )
+        for scope, name, failures, total in scopes:
+            if total >= self.min_hosts and failures >= self.threshold * total:
+                self.breach = {
+                    "scope": scope,
+                    "name": name,
+                    "play": event.play,
+                    "task": event.task,
+                    "failures": failures,
+                    "total": total,
+                    "rate": round(failures / total, 3),
+                    "threshold": self.threshold,
+                    "timestamp": event.timestamp,
+                }
+                return self.breach
+        return None
+
+
+class StreamingQuantile(object):
+    """Estimate a quantile in constant memory with the P-square algorithm.
+
+    Five markers track the minimum, maximum, the quantile and two midpoints;
+    no samples are stored beyond the first five.
+    """
+
+    def __init__(self, quantile=0.5):
+        self.quantile = quantile
+        self.count = 0
+        self._heights = []
+        self._positions = [1, 2, 3, 4, 5]
+        self._desired = [
+            1,
+            1 + 2 * quantile,
+            1 + 4 * quantile,
+            3 + 2 * quantile,
+            5,
+        ]
+        self._increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def add(self, value):
+        """Add a sample to the estimate."""
+        self.count += 1
+        if self.count <= 5:
+            bisect.insort(self._heights, value)
+            return
+
+        q = self._heights
+        n = self._positions
+        if value < q[0]:
+            q[0] = value
+            k = 0
+        elif value >= q[4]:
+            q[4] = value
+            k = 3
+        else:
+            k = bisect.bisect_right(q, value) - 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+
+        # Move the three middle markers towards their desired positions
+        for i in (1, 2, 3):
+            d = self._desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+                )
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def value(self):
+        """Return the current estimate, or 0.0 before any samples."""
+        if not self.count:
+            return 0.0
+        if self.count <= 5:
+            return self._heights[int(round((self.count - 1) * self.quantile))]
+        return self._heights[2]
+
+
+class StragglerDetector(EventSink):
+    """Flag hosts whose results arrive much later than the task median.
+
+    Arrival times are measured from the start of the task; the median is a
+    streaming estimate and only the worst stragglers are kept, so memory does
+    not grow with the number of hosts. The first straggler of each task is
+    announced as a warning.
+    """
+
+    name = "stragglers"
+
+    def __init__(self, factor, min_hosts):
+        self.factor = factor
+        self.min_hosts = max(int(min_hosts or 1), 1)
+        self.count = 0  # All stragglers found, including those not kept
+        self._worst = []  # Min-heap of the worst (ratio, count, straggler)
+        self._task_id = None
+        self._median = StreamingQuantile(0.5)
+        self._announced = False
+
+    def handle(self, event):
+        if event.kind == "task_start":
+            self.start_task(event.task_id)
+            return None
+        if event.kind != "result":
+            return None
+        straggler = self.observe(event)
+        if straggler is None or not self.announce():
+            return None
+        return [
+            f"::warning::Straggler: {straggler['host']} took "
+            f"{straggler['elapsed']:.1f}s on '{straggler['task']}' "
+            f"(median {straggler['median']:.1f}s)"
+        ]
+
+    def summary(self):
+        if not self.count:
+            return []
+        lines = [f"\nStragglers: {self.count}"]
+        for straggler in self.worst():
+            lines.append(
+                f"  {straggler['elapsed']:8.2f}s  {straggler['host']}  "
+                f"{straggler['play']} | {straggler['task']} "
+                f"(median {straggler['median']:.2f}s)"
+            )
+        return lines
+
+    def start_task(self, task_id):
+        """Reset the estimate for a newly started task."""
+        self._task_id = task_id
+        self._median = StreamingQuantile(0.5)
+        self._announced = False
+
+    def observe(self, event):
+        """Record an arrival; return the straggler entry if the host is one.
+
+        Skipped and unreachable results do not run the task, so they are left
+        out of the median and never flagged.
+        """
+        if not self.factor or event.task_id != self._task_id:
+            return None
+        if event.status in STRAGGLER_IGNORED_STATUSES:
+            return None
+        median = self._median.value()
+        self._median.add(event.elapsed)
+        if (
+            self._median.count <= self.min_hosts
+            or event.elapsed < median * self.factor
+            or event.elapsed - median < STRAGGLER_MIN_SECONDS
+        ):
+            return None
+        straggler = {
+            "host": event.host,
+            "play": event.play,
+            "task": event.task,
+            "elapsed": event.elapsed,
+            "median": round(median, 3),
+        }
+        self.count += 1
+        ratio = event.elapsed / max(straggler["median"], 0.001)
+        entry = (ratio, self.count, straggler)
+        if len(self._worst) < STRAGGLERS_SHOWN:
+            heapq.heappush(self._worst, entry)
+        elif entry > self._worst[0]:
+            heapq.heapreplace(self._worst, entry)
+        return straggler
+
+    def worst(self):
+        """Return the kept stragglers, slowest relative to their median first."""
+        return [entry[2] for entry in sorted(self._worst, reverse=True)]
+
+    def announce(self):
+        """Return True for the first straggler of the current task only."""
+        if self._announced:
+            return False
+        self._announced = True
+        return True
+
+
+class FactGatheringReport(EventSink):
+    """Collect per-host and per-play timing of fact gathering tasks.
+
+    A host's gathering time is the duration of its result, so waiting for a
+    fork is not counted. Times are kept per play; a host gathering facts
+    twice in one play is counted once with the sum.
+    """
+
+    name = "facts"
+
+    def __init__(self):
+        self.tasks = set()  # Task ids of fact gathering tasks
+        self.plays = {}  # play -> {"duration", "hosts", "timed_out"}
+
+    def handle(self, event):
+        if event.kind == "task_start":
+            self.start_task(event)
+        elif event.kind == "result":
+            self.observe(event)
+        elif event.kind == "task_end":
+            self.finish_task(event.task_id, event.play, event.duration)
+
+    def summary(self):
+        samples = [seconds for seconds, _, _ in self.samples()]
+        if not samples:
+            return []
+        slowest = self.slowest()
+        hosts = set(host for play in self.plays.values() for host in play["hosts"])
+        lines = [
+            f"\nFact gathering: {len(hosts)} hosts, median "
+            f"{statistics.median(samples):.2f}s, max {slowest[0][0]:.2f}s"
+        ]
+        for play_name, play in self.plays.items():
+            lines.append(
+                f"  Play {play_name}: {play['duration']:.2f}s gathering "
+                f"({len(play['hosts'])} hosts)"
+            )
+        lines.append(
+            "  Slowest: "
+            + ", ".join(f"{host} {seconds:.2f}s" for seconds, host, _ in slowest)
+        )
+        timed_out = list(
+            dict.fromkeys(
+                host for play in self.plays.values() for host in play["timed_out"]
+            )
+        )
+        if timed_out:
+            examples = ", ".join(timed_out[:FACT_HOSTS_SHOWN])
+            if len(timed_out) > FACT_HOSTS_SHOWN:
+                examples += f" (+{len(timed_out) - FACT_HOSTS_SHOWN} more)"
+            lines.append(f"  Timed out ({len(timed_out)}): {examples}")
+        return lines
+
+    def start_task(self, event):
+        """Remember the task if it gathers facts."""
+        if event.action in FACT_GATHERING_ACTIONS:
+            self.tasks.add(event.task_id)
+            self._play(event.play)
+
+    def observe(self, event):
+        """Record the gathering time of one host."""
+        if event.task_id not in self.tasks:
+            return
+        seconds = event.duration
+        play = self._play(event.play)
+        play["hosts"][event.host] = play["hosts"].get(event.host, 0.0) + seconds
+        if event.status in ("failed", "unreachable"):
+            msg = event.msg.lower()
+            if "timed out" in msg or "timeout" in msg:
+                play["timed_out"].setdefault(event.host, seconds)
+
+    def finish_task(self, task_id, play, elapsed):
+        """Add the wall time of a finished fact gathering task to its play."""
+        if task_id in self.tasks:
+            self._play(play)["duration"] += elapsed
+
+    def samples(self):
+        """Yield (seconds, host, play) for every host of every play."""
+        for play_name, play in self.plays.items():
+            for host, seconds in play["hosts"].items():
+                yield seconds, host, play_name
+
+    def slowest(self):
+        """Return the slowest (seconds, host, play) samples, slowest first."""
+        return heapq.nlargest(FACT_HOSTS_SHOWN, self.samples())
+
+    def _play(self, name):
+        """Return the entry of a play, creating it if needed."""
+        if name not in self.plays:
+            self.plays[name] = {"duration": 0.0, "hosts": {}, "timed_out": {}}
+        return self.plays[name]
+
+
+class HostContextBuffer(EventSink):
+    """Keep the last few results of each host in bounded memory.
+
+    Every host has a ring buffer of ``size`` short lines; at most
+    ``max_hosts`` buffers are kept and the least recently active host is
+    evicted first. The buffer of a failing host is shown in its own group for
+    the first ``CONTEXT_HOSTS_SHOWN`` failing hosts of a task; the others are
+    counted and reported once when the task ends.
+    """
+
+    name = "context"
+
+    def __init__(self, size, max_hosts):
+        self.size = max(int(size or 0), 0)
+        self.max_hosts = max(int(max_hosts or 1), 1)
+        self._hosts = OrderedDict()
+        self._shown = 0  # Context groups shown for the current task
+        self._omitted = 0  # Failing hosts of the current task not shown
+
+    def handle(self, event):
+        if event.kind == "task_end":
+            omitted, self._shown, self._omitted = self._omitted, 0, 0
+            if not omitted:
+                return None
+            noun = "host" if omitted == 1 else "hosts"
+            return [f"Context omitted for {omitted} more failing {noun}"]
+        if event.kind != "result":
+            return None
+        self.record(event)
+        if event.status not in ("failed", "unreachable") or event.ignore_errors:
+            return None
+        # The failure itself was just shown, context needs an earlier result
+        lines = self.lines(event.host)
+        if len(lines) < 2:
+            return None
+        if self._shown >= CONTEXT_HOSTS_SHOWN:
+            self._omitted += 1
+            return None
+        self._shown += 1
+        return (
+            [f"::group::Context: {event.host} (last {len(lines)} results)"]
+            + [f"  {line}" for line in lines]
+            + ["::endgroup::"]
+        )
+
+    def record(self, event):
+        """Append a one-line summary of a result to the host's buffer."""
+        if not self.size:
+            return
+        lines = self._hosts.get(event.host)
+        if lines is None:
+            lines = deque(maxlen=self.size)
+            self._hosts[event.host] = lines
+            if len(self._hosts) > self.max_hosts:
+                self._hosts.popitem(last=False)
+        else:
+            self._hosts.move_to_end(event.host)
+
+        line = f"{event.status} | {event.play} | {event.task} | {event.duration:.1f}s"
+        if event.rc is not None:
+            line += f" | rc={event.rc}"
+        if event.status in ("failed", "unreachable") and event.msg:
+            line += " | " + event.msg[:CONTEXT_MSG_CHARS].replace("\n", " ")
+        lines.append(line)
+
+    def lines(self, hostname):
+        """Return the buffered lines of a host, oldest first."""
+        return list(self._hosts.get(hostname, ()))
+
+    def __len__(self):
+        return len(self._hosts)
+
+
+def host_in_sample(hostname, rate):
+    """Return True if the host falls in the deterministic sample for rate.
+
+    The decision depends only on the host name, so the same hosts are shown
+    for every task and in every run.
+    """
+    if rate >= 1:
+        return True
+    bucket = zlib.crc32(hostname.encode("utf-8", "replace")) / 0x100000000
+    return bucket < rate
+
+
+def _task_file(path):
+    """Strip the trailing line number from a task path ("file.yml:12")."""
+    filename, sep, line = (path or "").rpartition(":")
+    if sep and line.isdigit():
+        return filename
+    return path or "(unknown)"
+
+
+def classify_unreachable(msg):
+    """Return the connection failure category for an unreachable message."""
+    text = (msg or "").lower()
+    for category, patterns in UNREACHABLE_CATEGORIES:
+        for pattern in patterns:
+            if pattern in text:
+                return category
+    return "other"
+
+
+class UnreachableTracker(EventSink):
+    """Record the first connection failure of every unreachable host.
+
+    The hosts are written to ``retry_file``, one per line, when the run ends.
+    """
+
+    name = "unreachable"
+
+    def __init__(self, retry_file=None):
+        self.retry_file = retry_file
+        self.hosts = {}  # host -> {"category", "play", "task", "msg"}
+
+    def handle(self, event):
+        if event.kind == "result" and event.status == "unreachable":
+            self.record(event)
+
+    def summary(self):
+        if not self.hosts:
+            return []
+        lines = [f"\nUnreachable hosts: {len(self.hosts)}"]
+        for (category, play, task), hosts in self.groups():
+            examples = ", ".join(hosts[:UNREACHABLE_HOSTS_SHOWN])
+            if len(hosts) > UNREACHABLE_HOSTS_SHOWN:
+                examples += f" (+{len(hosts) - UNREACHABLE_HOSTS_SHOWN} more)"
+            lines.append(
+                f"  {category:<9} {len(hosts):>6}  {play} | {task}  [{examples}]"
+            )
+        return lines
+
+    def close(self):
+        if not self.retry_file:
+            return
+        with open(self.retry_file, "w", encoding="utf-8") as f:
+            for hostname in sorted(self.hosts):
+                f.write(hostname + "\n")
+
+    def record(self, event):
+        """Classify an unreachable result unless the host already failed."""
+        if event.host in self.hosts:
+            return
+        self.hosts[event.host] = {
+            "category": classify_unreachable(event.msg),
+            "play": event.play,
+            "task": event.task,
+            "msg": event.msg,
+        }
+
+    def groups(self):
+        """Group hosts by category and first failing task, largest group first."""
+        groups = {}
+        for host, info in self.hosts.items():
+            key = (info["category"], info["play"], info["task"])
+            groups.setdefault(key, []).append(host)
+        return sorted(groups.items(), key=lambda item: (-len(item[1]), item[0]))
+
 
 class CallbackModule(CallbackBase):
     CALLBACK_VERSION = 2.0
@@ -26,7 +1034,6 @@ class CallbackModule(CallbackBase):
 
     def __init__(self):
         super(CallbackModule, self).__init__()
-        self.archive_lines = []
         self.stats = {
             "totals": {
                 "ok": 0,
@@ -36,45 +1043,409 @@ class CallbackModule(CallbackBase):
                 "unreachable": 0,
             },
             "plays": {},
+            "tasks": {},  # Per-task counts and wall time, keyed by task id
+            "rollup": {"roles": {}, "files": {}},  # Counts and time per role/file
         }
         self._play_group_open = False
         self._task_group_open = False
         self._current_play = None
         self._current_task = None
+        self._current_task_id = None
+        self._task_started = None  # Monotonic start time of the current task
+        self._host_started = {}  # host -> (task id, monotonic start time)
+        self._task_diffs = {}  # Unique diffs of the current task, keyed by digest
+        self._check_mode_tasks = 0  # Number of tasks that ran in check mode
+        self._sampled_out = 0  # ok/skipped lines not shown because of sampling
         self._seen_hosts = set()  # Track hosts we've seen for smart grouping
         self._smart_grouping_decided = (
             False  # Whether we've decided on grouping for current play
         )
 
-        # Initialize with defaults (will be overridden by set_options if called)
-        self.verbose = DEFAULT_CONFIG["verbose"]
-        self.archive_file = DEFAULT_CONFIG["archive_file"]
-        self.grouping_mode = DEFAULT_CONFIG["grouping"]
-        self.current_grouping = self.grouping_mode  # Set initial grouping
+        # Defaults until set_options is called with the configured values
+        self._apply_options(DEFAULT_CONFIG)
 
     def set_options(self, task_keys=None, var_options=None, direct=None):
         super(CallbackModule, self).set_options(
             task_keys=task_keys, var_options=var_options, direct=direct
         )
+        options = {}
+        for name, default in DEFAULT_CONFIG.items():
+            try:
+                options[name] = self.get_option(name)
+            except KeyError:
+                # No definitions are registered when the plugin is not loaded
+                # through Ansible's plugin loader
+                options[name] = default
+        self._apply_options(options)
+
+    def _apply_options(self, options):
+        """Store option values and rebuild the sinks and analysers using them."""
+        for name, value in options.items():
+            setattr(self, OPTION_ATTRIBUTES.get(name, name), value)
+        self.current_grouping = self.grouping_mode
+        self.archive = ArchiveSink(self.archive_file) if self.archive_file else None
+        self.sinks = self._build_sinks()
+
+    def _build_sinks(self):
+        """Create the analysers and the optional event sinks enabled by configuration.
+
+        Analysers are also kept as attributes; their summary sections are
+        shown in the order of the returned list.
+        """
+        self.failure_monitor = FailureRateMonitor(
+            self.fail_threshold, self.fail_min_hosts, self.fail_marker_file
+        )
+        self.straggler_detector = StragglerDetector(
+            self.straggler_factor, self.straggler_min_hosts
+        )
+        self.fact_report = FactGatheringReport()
+        self.host_context = HostContextBuffer(self.context_lines, self.context_hosts)
+        self.unreachable = UnreachableTracker(self.retry_file)
+        sinks = [
+            self.failure_monitor,
+            self.straggler_detector,
+            self.fact_report,
+            self.host_context,
+            self.unreachable,
+        ]
+        if self.json_file:
+            sinks.append(JsonLinesSink(self.json_file))
+        if self.metrics_file:
+            sinks.append(MetricsSink(self.metrics_file))
+        return sinks
+
+    def _dispatch(self, event):
+        """Hand an event to every enabled sink, disabling sinks that fail."""
+        for sink in list(self.sinks):
+            try:
+                lines = sink.handle(event)
+            except Exception as e:
+                self.sinks.remove(sink)
+                self._emit(f"::notice::Disabled {sink.name} sink: {str(e)}")
+                continue
+            if lines:
+                self._emit_sink_lines(lines)
+
+    def _emit_sink_lines(self, lines):
+        """Show lines returned by a sink, suspending the open group if needed."""
+        # Groups cannot be nested, so close the open group and reopen it after
+        reopen = None
+        if any(line.startswith("::group::") for line in lines):
+            if self._task_group_open:
+                reopen = self._current_task
+            elif self._play_group_open:
+                reopen = f"Play: {self._current_play}"
+            if reopen is not None:
+                self._emit("::endgroup::")
+
+        for line in lines:
+            self._emit(line)
+
+        if reopen is not None:
+            self._emit(f"::group::{reopen}")
+
+    def _sink_summaries(self):
+        """Return the summary sections contributed by the sinks."""
+        lines = []
+        for sink in self.sinks:
+            try:
+                lines.extend(sink.summary())
+            except Exception as e:
+                lines.append(f"::notice::Failed to summarise {sink.name}: {str(e)}")
+        return lines
+
+    def _close_sinks(self):
+        """Close all sinks, reporting but not raising failures."""
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                self._emit(f"::notice::Failed to close {sink.name} sink: {str(e)}")
+
+    def _emit(self, line):
+        """Write a rendered line to stdout and the archive."""
+        self._display.display(line)
+        if self.archive is None:
+            return
         try:
-            self.verbose = self.get_option("verbose")
-            self.archive_file = self.get_option("archive_file")
-            self.grouping_mode = self.get_option("grouping")
-            self.current_grouping = self.grouping_mode  # Initialize current grouping
-        except:
-            self.verbose = DEFAULT_CONFIG["verbose"]
-            self.archive_file = DEFAULT_CONFIG["archive_file"]
-            self.grouping_mode = DEFAULT_CONFIG["grouping"]
-            self.current_grouping = self.grouping_mode  # Initialize current grouping
+            self.archive.write(line)
+        except Exception as e:
+            # Use notice level to avoid breaking the workflow
+            self.archive = None
+            self._display.display(
+                f"::notice::Failed to write archive file {self.archive_file}: {str(e)}"
+            )
 
     def v2_playbook_on_play_start(self, play):
+        self._finish_task()
+        event = PlayStartEvent(play.get_name().strip(), time.time())
+        self._render_play_start(event)
+        self._dispatch(event)
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._start_task(task, handler=False)
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._start_task(task, handler=True)
+
+    def v2_playbook_on_include(self, included_file):
+        hosts = getattr(included_file, "_hosts", None) or []
+        event = IncludeEvent(
+            getattr(included_file, "_filename", "") or "",
+            tuple(h.get_name() if hasattr(h, "get_name") else str(h) for h in hosts),
+            self._current_play or "",
+            time.time(),
+        )
+        self._emit(f"included: {event.path} for {', '.join(event.hosts)}")
+        self._dispatch(event)
+
+    def v2_playbook_on_no_hosts_matched(self):
+        event = PlayNoticeEvent(
+            "no_hosts_matched", self._current_play or "", time.time()
+        )
+        self._emit(f"::notice::No hosts matched, skipping play: {event.play}")
+        self._dispatch(event)
+
+    def v2_playbook_on_no_hosts_remaining(self):
+        event = PlayNoticeEvent(
+            "no_hosts_remaining", self._current_play or "", time.time()
+        )
+        self._finish_task()
+        self._flush_diffs()
+        if self._task_group_open:
+            self._emit("::endgroup::")
+            self._task_group_open = False
+        self._emit(f"::error::No more hosts left in play: {event.play}")
+        self._dispatch(event)
+
+    def _start_task(self, task, handler):
+        """Finish the running task and start tracking a new task or handler."""
+        self._finish_task()
+        self._task_started = time.monotonic()
+        task_name = task.get_name().strip()
+        event = TaskStartEvent(
+            f"Handler: {task_name}" if handler else task_name,
+            getattr(task, "_uuid", None) or f"{self._current_play}:{task_name}",
+            self._task_path(task),
+            self._task_role(task),
+            getattr(task, "action", None) or "",
+            self._current_play or "",
+            handler,
+            self._task_check_mode(task),
+            time.time(),
+        )
+        self._record_task_start(event)
+        self._render_task_start(event)
+        self._dispatch(event)
+
+    def v2_runner_on_start(self, host, task):
+        # A host runs one task at a time, so this holds one entry per host
+        self._host_started[host.get_name()] = (
+            getattr(task, "_uuid", None),
+            time.monotonic(),
+        )
+
+    def v2_runner_on_ok(self, result):
+        event = self._extract_result(result, "ok")
+        # Check if this is actually a changed result reported as ok
+        if event.changed:
+            event = event._replace(status="changed")
+        self._handle_result(event)
+
+    def v2_runner_on_changed(self, result):
+        self._handle_result(self._extract_result(result, "changed"))
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._handle_result(
+            self._extract_result(result, "failed", ignore_errors=ignore_errors)
+        )
+
+    def v2_runner_on_skipped(self, result):
+        self._handle_result(self._extract_result(result, "skipped"))
+
+    def v2_runner_on_unreachable(self, result):
+        self._handle_result(self._extract_result(result, "unreachable"))
+
+    def v2_on_file_diff(self, result):
+        payload = result._result if hasattr(result, "_result") else {}
+        if not payload or not payload.get("diff"):
+            return
+        event = self._extract_diff(result, payload["diff"])
+        if event is not None:
+            self._render_diff(event)
+            self._dispatch(event)
+
+    def v2_playbook_on_stats(self, stats):
+        self._finish_task()
+        self._render_stats()
+        self._dispatch(
+            StatsEvent(
+                self.stats["totals"],
+                self.stats["plays"],
+                self.stats["tasks"],
+                self.stats["rollup"],
+                self.fact_report.plays,
+                self.unreachable.hosts,
+                time.time(),
+            )
+        )
+        self._close_sinks()
+        self._close_archive()
+
+    def _task_path(self, task):
+        """Return the task's source path, or an empty string if unknown."""
+        try:
+            return (task.get_path() or "") if task else ""
+        except Exception:
+            return ""
+
+    def _task_role(self, task):
+        """Return the name of the role the task belongs to, or an empty string."""
+        try:
+            role = getattr(task, "_role", None)
+            return role.get_name() if role else ""
+        except Exception:
+            return ""
+
+    def _task_check_mode(self, task):
+        """Return True if the task runs in check mode."""
+        check_mode = getattr(task, "check_mode", None)
+        if check_mode is None:
+            check_mode = context.CLIARGS.get("check", False)
+        return check_mode is True
+
+    def _extract_diff(self, result, diff):
+        """Build a DiffEvent with a line-bounded copy of the unified diff."""
+        try:
+            text = self._get_diff(diff)
+        except Exception as e:
+            self._emit(f"::notice::Failed to render diff: {str(e)}")
+            return None
+        if not text.strip():
+            return None
+
+        digest = hashlib.sha1(text.encode("utf-8", "replace")).hexdigest()
+        known = self._task_diffs.get(digest)
+        if known is not None:
+            lines, omitted = known["lines"], known["omitted"]
+        else:
+            all_lines = text.rstrip("\n").splitlines()
+            limit = self.diff_lines or len(all_lines)
+            lines = tuple(all_lines[:limit])
+            omitted = len(all_lines) - len(lines)
+
+        hostname = (
+            result._host.get_name()
+            if hasattr(result, "_host") and result._host
+            else "unknown"
+        )
+        return DiffEvent(
+            hostname,
+            self._current_play or "",
+            self._current_task or "",
+            digest,
+            lines,
+            omitted,
+            time.time(),
+        )
+
+    def _extract_result(self, result, status, ignore_errors=False):
+        """Build a ResultEvent from an Ansible result object.
+
+        Text fields are truncated to ``output_limit`` characters so that large
+        module return payloads are never kept alive by the callback.
+        """
+        task = result._task if hasattr(result, "_task") else None
+        payload = (
+            result._result if hasattr(result, "_result") and result._result else {}
+        )
+        hostname = (
+            result._host.get_name()
+            if hasattr(result, "_host") and result._host
+            else "unknown"
+        )
+        # Attribute the result to the task that produced it, which differs from
+        # the most recently started task for handlers and the free strategy
+        task_id = getattr(task, "_uuid", None) if task else None
+        task_entry = self.stats["tasks"].get(task_id) if task_id else None
+        if task_entry is None:
+            task_id = self._current_task_id
+            task_entry = self.stats["tasks"].get(task_id) if task_id else None
+        rc = payload.get("rc")
+        now = time.monotonic()
+        elapsed = now - self._task_started if self._task_started is not None else 0.0
+        # The host's own run time, unless its start was not reported
+        started = self._host_started.pop(hostname, None)
+        if started is not None and started[0] == getattr(task, "_uuid", None):
+            duration = now - started[1]
+        else:
+            duration = elapsed
+        return ResultEvent(
+            status,
+            hostname,
+            self._current_play or "",
+            task_entry["name"] if task_entry else self._current_task or "",
+            task_id,
+            self._task_path(task),
+            bool(payload.get("changed", False)),
+            _truncate(payload.get("msg"), self.output_limit),
+            rc if isinstance(rc, int) else None,
+            _truncate(payload.get("stdout"), self.output_limit),
+            _truncate(payload.get("stderr"), self.output_limit),
+            round(duration, 3),
+            round(elapsed, 3),
+            ignore_errors,
+            time.time(),
+        )
+
+    def _handle_result(self, event):
+        """Render, count and dispatch a single result event."""
+        self._render_result(event)
+
+        # Show detailed error message if verbose mode is enabled
+        if self.verbose and event.status == "failed":
+            self._render_failure_details(event)
+
+        self._record_stats(event)
+        self._dispatch(event)
+
+    def _render_diff(self, event):
+        """Collect a diff for display at the end of the current task."""
+        entry = self._task_diffs.get(event.digest)
+        if entry is None:
+            entry = {"lines": event.lines, "omitted": event.omitted, "hosts": []}
+            self._task_diffs[event.digest] = entry
+        entry["hosts"].append(event.host)
+
+    def _flush_diffs(self):
+        """Show each unique diff of the finished task once with its hosts."""
+        for entry in self._task_diffs.values():
+            hosts = entry["hosts"]
+            host_list = ", ".join(hosts[:DIFF_HOSTS_SHOWN])
+            if len(hosts) > DIFF_HOSTS_SHOWN:
+                host_list += f" (+{len(hosts) - DIFF_HOSTS_SHOWN} more)"
+            noun = "host" if len(hosts) == 1 else "hosts"
+            self._emit(f"Diff ({len(hosts)} {noun}): {host_list}")
+            for line in entry["lines"]:
+                self._emit(line)
+            if entry["omitted"]:
+                self._emit(f"... [diff truncated, {entry['omitted']} more lines]")
+        self._task_diffs = {}
+
+    def _render_play_start(self, event):
+        self._flush_diffs()
+
+        # Close the last task or handler group of the previous play
+        if self._task_group_open:
+            self._emit("::endgroup::")
+            self._task_group_open = False
+
         # Close previous play group if open
         if self._play_group_open:
-            self._display.display("::endgroup::")
-            self.archive_lines.append("::endgroup::")
+            self._emit("::endgroup::")
             self._play_group_open = False
 
-        play_name = play.get_name().strip()
+        play_name = event.play
         self._current_play = play_name
         self._seen_hosts.clear()  # Reset for new play
         self._smart_grouping_decided = False  # Reset decision for new play
@@ -92,141 +1463,150 @@ class CallbackModule(CallbackBase):
 
         # Start play group only if grouping by play
         if self.current_grouping == "play":
-            self._display.display(f"::group::Play: {play_name}")
-            self.archive_lines.append(f"::group::Play: {play_name}")
+            self._emit(f"::group::Play: {play_name}")
             self._play_group_open = True
 
-    def v2_playbook_on_task_start(self, task, is_conditional):
+    def _render_task_start(self, event):
+        self._flush_diffs()
+        if event.check_mode:
+            self._check_mode_tasks += 1
+
         # Close previous task group if open
         if self._task_group_open:
-            self._display.display("::endgroup::")
-            self.archive_lines.append("::endgroup::")
+            self._emit("::endgroup::")
             self._task_group_open = False
 
-        task_name = task.get_name().strip()
+        task_name = event.task
         self._current_task = task_name
 
         # Start task group only if grouping by task
         if self.current_grouping == "task":
-            self._display.display(f"::group::{task_name}")
-            self.archive_lines.append(f"::group::{task_name}")
+            self._emit(f"::group::{task_name}")
             self._task_group_open = True
 
-    def v2_runner_on_ok(self, result):
-        # Check if this is actually a changed result reported as ok
-        actual_status = "ok"
-        if hasattr(result, "_result") and result._result:
-            if result._result.get("changed", False):
-                actual_status = "changed"
-                self._update_stats(result, "changed")
-            else:
-                self._update_stats(result, "ok")
-        else:
-            self._update_stats(result, "ok")
-
-        self._emit_task_line(result, status=actual_status)
+    def _render_failure_details(self, event):
+        """Show the error message and stderr of a failed result."""
+        if event.msg:
+            self._emit(f"::error::Error details: {event.msg}")
 
-    def v2_runner_on_changed(self, result):
-        self._emit_task_line(result, status="changed")
-        self._update_stats(result, "changed")
+        # Include stderr if available
+        if event.stderr:
+            self._emit(f"::error::STDERR: {event.stderr}")
 
-    def v2_runner_on_failed(self, result, ignore_errors=False):
-        self._emit_task_line(result, status="failed")
-        self._update_stats(result, "failed")
+    def _render_stats(self):
+        self._flush_diffs()
 
-        # Show detailed error message if verbose mode is enabled
-        if self.verbose and hasattr(result, "_result"):
-            error_msg = result._result.get("msg", "")
-            if error_msg:
-                self._display.display(f"::error::Error details: {error_msg}")
-                self.archive_lines.append(f"::error::Error details: {error_msg}")
-
-            # Include stderr if available
-            stderr = result._result.get("stderr", "")
-            if stderr:
-                self._display.display(f"::error::STDERR: {stderr}")
-                self.archive_lines.append(f"::error::STDERR: {stderr}")
-
-    def v2_runner_on_skipped(self, result):
-        self._emit_task_line(result, status="skipped")
-        self._update_stats(result, "skipped")
-
-    def v2_runner_on_unreachable(self, result):
-        self._emit_task_line(result, status="unreachable")
-        self._update_stats(result, "unreachable")
-
-    def v2_playbook_on_stats(self, stats):
         # Close any open task group
         if self._task_group_open:
-            self._display.display("::endgroup::")
-            self.archive_lines.append("::endgroup::")
+            self._emit("::endgroup::")
             self._task_group_open = False
 
         # Close any open play group
         if self._play_group_open:
-            self._display.display("::endgroup::")
-            self.archive_lines.append("::endgroup::")
+            self._emit("::endgroup::")
             self._play_group_open = False
 
         # Generate summary statistics
-        self._display.display("::group::Summary Statistics")
-        self.archive_lines.append("::group::Summary Statistics")
+        self._emit("::group::Summary Statistics")
 
         # Overall totals
         summary_line = f"Total: {self.stats['totals']['ok']} ok, {self.stats['totals']['changed']} changed, {self.stats['totals']['failed']} failed, {self.stats['totals']['skipped']} skipped, {self.stats['totals']['unreachable']} unreachable"
-        self._display.display(summary_line)
-        self.archive_lines.append(summary_line)
+        self._emit(summary_line)
 
         # Show grouping mode info
         mode_info = f"Grouping mode: {self.grouping_mode}"
         if self.grouping_mode == "smart":
             mode_info += f" (using {self.current_grouping} grouping)"
-        self._display.display(mode_info)
-        self.archive_lines.append(mode_info)
+        self._emit(mode_info)
+
+        if self.sample_rate < 1:
+            self._emit(
+                f"Sampling: ok/skipped lines shown for {self.sample_rate * 100:g}% "
+                f"of hosts ({self._sampled_out} lines omitted, "
+                "changed/failed/unreachable always shown)"
+            )
+
+        # Check mode marker: changed counts are changes that would be made
+        if self._check_mode_tasks:
+            noun = "task" if self._check_mode_tasks == 1 else "tasks"
+            self._emit(
+                f"Check mode: {self._check_mode_tasks} {noun} ran in check mode, "
+                "changed results were not applied"
+            )
 
         # Per-play breakdown
         for play_name, play_stats in self.stats["plays"].items():
-            self._display.display(f"\nPlay: {play_name}")
-            self.archive_lines.append(f"\nPlay: {play_name}")
+            self._emit(f"\nPlay: {play_name}")
 
             for hostname, host_stats in play_stats.items():
                 host_line = f"  {hostname}: {host_stats['ok']} ok, {host_stats['changed']} changed, {host_stats['failed']} failed, {host_stats['skipped']} skipped, {host_stats['unreachable']} unreachable"
-                self._display.display(host_line)
-                self.archive_lines.append(host_line)
+                self._emit(host_line)
+
+        # Sections of the analysers: early failures, stragglers, fact
+        # gathering, unreachable hosts
+        for line in self._sink_summaries():
+            self._emit(line)
+
+        self._render_rollup()
+        self._render_slowest_tasks()
+
+        self._emit("::endgroup::")
 
-        self._display.display("::endgroup::")
-        self.archive_lines.append("::endgroup::")
+    def _render_rollup(self):
+        """Show time and results per role and per task file, most expensive first."""
+        for title, scope in (("Roles", "roles"), ("Task files", "files")):
+            bucket = self.stats["rollup"][scope]
+            if not bucket:
+                continue
+            self._emit(f"\n{title}:")
+            ranked = sorted(
+                bucket.items(), key=lambda item: item[1]["duration"], reverse=True
+            )
+            for name, entry in ranked[:ROLLUP_SHOWN]:
+                self._emit(
+                    f"  {entry['duration']:8.2f}s  {entry['tasks']:>4} tasks  {name}"
+                    f" ({entry['ok']} ok, {entry['changed']} changed,"
+                    f" {entry['failed']} failed, {entry['skipped']} skipped,"
+                    f" {entry['unreachable']} unreachable)"
+                )
 
-        # Write archive file
-        self._write_archive_file()
+    def _render_slowest_tasks(self):
+        """Show the slowest tasks, including handlers."""
+        slowest = sorted(
+            self.stats["tasks"].values(), key=lambda t: t["duration"], reverse=True
+        )[:SLOWEST_TASKS_SHOWN]
+        if slowest:
+            self._emit("\nSlowest tasks:")
+            for task_stats in slowest:
+                self._emit(
+                    f"  {task_stats['duration']:8.2f}s  "
+                    f"{task_stats['play']} | {task_stats['name']}"
+                    f" ({task_stats['ok']} ok, {task_stats['changed']} changed,"
+                    f" {task_stats['failed']} failed, {task_stats['skipped']} skipped,"
+                    f" {task_stats['unreachable']} unreachable)"
+                )
 
-    def _write_archive_file(self):
-        """Write all collected output to the archive file."""
+    def _close_archive(self):
+        """Close the archive file; later lines are only shown on stdout."""
+        archive, self.archive = self.archive, None
+        if archive is None:
+            return
         try:
-            with open(self.archive_file, "w", encoding="utf-8") as f:
-                for line in self.archive_lines:
-                    f.write(line + "\n")
+            archive.close()
         except Exception as e:
-            # Use notice level to avoid breaking the workflow
-            error_msg = (
+            self._display.display(
                 f"::notice::Failed to write archive file {self.archive_file}: {str(e)}"
             )
-            self._display.display(error_msg)
 
     def _emit_task_line(self, result, status):
+        self._render_result(self._extract_result(result, status))
+
+    def _render_result(self, event):
         try:
-            filename = (
-                os.path.basename(result._task.get_path() or "")
-                if hasattr(result, "_task") and result._task
-                else ""
-            )
-            play_name = self._current_play or ""
-            hostname = (
-                result._host.get_name()
-                if hasattr(result, "_host") and result._host
-                else "unknown"
-            )
-            task_name = self._current_task or ""
+            filename = os.path.basename(event.path)
+            play_name = event.play
+            hostname = event.host
+            task_name = event.task
 
             # Track hosts for smart grouping
             if self.grouping_mode == "smart" and not self._smart_grouping_decided:
@@ -236,8 +1616,7 @@ class CallbackModule(CallbackBase):
                 if len(self._seen_hosts) > 1 and self.current_grouping == "play":
                     # Close the current play group
                     if self._play_group_open:
-                        self._display.display("::endgroup::")
-                        self.archive_lines.append("::endgroup::")
+                        self._emit("::endgroup::")
                         self._play_group_open = False
 
                     # Switch to task grouping
@@ -247,22 +1626,25 @@ class CallbackModule(CallbackBase):
                     # Debug output when verbose mode is enabled
                     if self.verbose:
                         debug_msg = f"::notice::Smart grouping: switching to task grouping (detected {len(self._seen_hosts)} hosts)"
-                        self._display.display(debug_msg)
-                        self.archive_lines.append(debug_msg)
+                        self._emit(debug_msg)
 
                     # Start task group for current task if we have one
                     if self._current_task and not self._task_group_open:
-                        self._display.display(f"::group::{self._current_task}")
-                        self.archive_lines.append(f"::group::{self._current_task}")
+                        self._emit(f"::group::{self._current_task}")
                         self._task_group_open = True
 
             # Debug: Check for changed flag in verbose mode
-            if self.verbose and hasattr(result, "_result") and result._result:
-                changed_flag = result._result.get("changed", False)
-                if changed_flag and status == "ok":
-                    debug_line = f"::notice::DEBUG: Task reported changed=true but status=ok for {task_name}"
-                    self._display.display(debug_line)
-                    self.archive_lines.append(debug_line)
+            if self.verbose and event.changed and event.status == "ok":
+                debug_line = f"::notice::DEBUG: Task reported changed=true but status=ok for {task_name}"
+                self._emit(debug_line)
+
+            # Sampling only hides ok/skipped lines; statistics stay exact
+            status = event.status
+            if status in ("ok", "skipped") and not host_in_sample(
+                hostname, self.sample_rate
+            ):
+                self._sampled_out += 1
+                return
 
             # Format: filename | hostname | status | play_name | task_name
             line = f"{filename} | {hostname} | {status} | {play_name} | {task_name}"
@@ -279,23 +1661,83 @@ class CallbackModule(CallbackBase):
             else:
                 output_line = line
 
-            self._display.display(output_line)
-            self.archive_lines.append(output_line)
+            self._emit(output_line)
         except Exception as e:
             # Fallback error message
             error_line = f"::error::Failed to format task line: {str(e)}"
-            self._display.display(error_line)
-            self.archive_lines.append(error_line)
+            self._emit(error_line)
+
+    def _record_task_start(self, event):
+        """Register a task or handler for per-task statistics."""
+        self._current_task_id = event.task_id
+        if event.task_id not in self.stats["tasks"]:
+            role = event.role or "(no role)"
+            for entry in self._rollup_entries(role, _task_file(event.path)):
+                entry["tasks"] += 1
+            self.stats["tasks"][event.task_id] = {
+                "name": event.task,
+                "play": event.play,
+                "handler": event.handler,
+                "role": role,
+                "file": _task_file(event.path),
+                "ok": 0,
+                "changed": 0,
+                "failed": 0,
+                "skipped": 0,
+                "unreachable": 0,
+                "duration": 0.0,
+            }
+
+    def _finish_task(self):
+        """Add the wall time of the running task to its statistics."""
+        task_id = self._current_task_id
+        task_stats = self.stats["tasks"].get(task_id)
+        self._current_task_id = None
+        if task_stats is None or self._task_started is None:
+            return
+
+        elapsed = time.monotonic() - self._task_started
+        task_stats["duration"] += elapsed
+        for entry in self._rollup_entries(task_stats["role"], task_stats["file"]):
+            entry["duration"] += elapsed
+        self._dispatch(
+            TaskEndEvent(
+                task_stats["name"],
+                task_id,
+                task_stats["play"],
+                round(elapsed, 3),
+                time.time(),
+            )
+        )
+
+    def _rollup_entries(self, role, filename):
+        """Return the role and task file rollup entries, creating them if needed."""
+        entries = []
+        for scope, key in (("roles", role), ("files", filename)):
+            bucket = self.stats["rollup"][scope]
+            if key not in bucket:
+                bucket[key] = {
+                    "tasks": 0,
+                    "ok": 0,
+                    "changed": 0,
+                    "failed": 0,
+                    "skipped": 0,
+                    "unreachable": 0,
+                    "duration": 0.0,
+                }
+            entries.append(bucket[key])
+        return entries
 
     def _update_stats(self, result, status):
         """Update statistics for the given result and status."""
+        self._record_stats(self._extract_result(result, status))
+
+    def _record_stats(self, event):
+        """Update statistics for the given result event."""
         try:
-            hostname = (
-                result._host.get_name()
-                if hasattr(result, "_host") and result._host
-                else "unknown"
-            )
-            play_name = self._current_play or "unknown"
+            hostname = event.host
+            status = event.status
+            play_name = event.play or "unknown"
 
             # Initialize play stats if needed
             if play_name not in self.stats["plays"]:
@@ -317,8 +1759,15 @@ class CallbackModule(CallbackBase):
 
             if status in self.stats["totals"]:
                 self.stats["totals"][status] += 1
+
+            task_stats = self.stats["tasks"].get(event.task_id)
+            if task_stats is not None and status in task_stats:
+                task_stats[status] += 1
+                for entry in self._rollup_entries(
+                    task_stats["role"], task_stats["file"]
+                ):
+                    entry[status] += 1
         except Exception as e:
             # Log error but don't break execution
             error_msg = f"::notice::Failed to update statistics: {str(e)}"
-            self._display.display(error_msg)
-            self.archive_lines.append(error_msg)
+            self._emit(error_msg)
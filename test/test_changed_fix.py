@@ -11,7 +11,11 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from github_actions import CallbackModule
 
 class MockDisplay:
+    def __init__(self):
+        self.lines = []
+
     def display(self, msg):
+        self.lines.append(msg)
         print(msg)
 
 class MockTask:
@@ -33,6 +37,7 @@ def test_changed_detection():
     
     plugin = CallbackModule()
     plugin._display = MockDisplay()
+    plugin.archive = None  # Output is only shown, no archive file is written
     plugin._current_play = "Test Play"
     plugin._current_task = "Test Task"
     
@@ -51,8 +56,8 @@ def test_changed_detection():
     plugin.v2_runner_on_changed(result_direct)
     print(f"   Stats - OK: {plugin.stats['totals']['ok']}, Changed: {plugin.stats['totals']['changed']}")
     
-    print("\n4. Archive lines (last 3):")
-    for line in plugin.archive_lines[-3:]:
+    print("\n4. Output lines (last 3):")
+    for line in plugin._display.lines[-3:]:
         print(f"   {line}")
 
 if __name__ == "__main__":
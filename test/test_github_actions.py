@@ -2,14 +2,43 @@ import unittest
 import tempfile
 import os
 import sys
+from unittest import mock
+from ansible.plugins.loader import callback_loader
 # Add parent directory to path to import the callback module
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from github_actions import CallbackModule
+from github_actions import (
+    CONTEXT_HOSTS_SHOWN,
+    DEFAULT_CONFIG,
+    CallbackModule,
+    EventSink,
+    HostContextBuffer,
+    STRAGGLERS_SHOWN,
+    StragglerDetector,
+    StreamingQuantile,
+    classify_unreachable,
+    host_in_sample,
+)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 class TestGithubActionsCallback(unittest.TestCase):
     def setUp(self):
+        self.output = []
         self.plugin = CallbackModule()
-        self.plugin._display = type('Display', (), {'display': lambda self, msg: None})()
+        self.plugin._display = type('Display', (), {'display': lambda display, msg: self.output.append(msg)})()
+        # Output is checked through the display, no archive file is written
+        self.plugin.archive = None
+
+    def configured_plugin(self, **options):
+        """Load the plugin through Ansible and configure it from GITHUB_ACTIONS_* variables"""
+        callback_loader.add_directory(REPO_DIR)
+        options.setdefault('archive_file', os.path.join(tempfile.mkdtemp(), 'archive.log'))
+        env = {f'GITHUB_ACTIONS_{name.upper()}': str(value) for name, value in options.items()}
+        with mock.patch.dict(os.environ, env):
+            plugin = callback_loader.get('github_actions')
+            plugin.set_options()
+        plugin._display = self.plugin._display
+        return plugin
 
     def test_ok_status_output(self):
         result = type('Result', (), {
@@ -19,7 +48,7 @@ class TestGithubActionsCallback(unittest.TestCase):
         self.plugin._current_play = 'TestPlay'
         self.plugin._current_task = 'TestTask'
         self.plugin._emit_task_line(result, status='ok')
-        self.assertIn('::notice::', self.plugin.archive_lines[-1])
+        self.assertIn('::notice::', self.output[-1])
 
     def test_changed_detection_in_ok_result(self):
         """Test that changed=true in result is detected even when reported as 'ok'"""
@@ -35,7 +64,7 @@ class TestGithubActionsCallback(unittest.TestCase):
         self.plugin.v2_runner_on_ok(result)
         
         # Should have detected the change and marked as warning
-        self.assertIn('::warning::', self.plugin.archive_lines[-1])
+        self.assertIn('::warning::', self.output[-1])
         self.assertEqual(self.plugin.stats['totals']['changed'], 1)
         self.assertEqual(self.plugin.stats['totals']['ok'], 0)
 
@@ -48,7 +77,7 @@ class TestGithubActionsCallback(unittest.TestCase):
         self.plugin._current_play = 'TestPlay'
         self.plugin._current_task = 'TestTask'
         self.plugin.v2_runner_on_changed(result)
-        self.assertIn('::warning::', self.plugin.archive_lines[-1])
+        self.assertIn('::warning::', self.output[-1])
 
     def test_failed_status_output(self):
         result = type('Result', (), {
@@ -58,7 +87,7 @@ class TestGithubActionsCallback(unittest.TestCase):
         self.plugin._current_play = 'TestPlay'
         self.plugin._current_task = 'TestTask'
         self.plugin._emit_task_line(result, status='failed')
-        self.assertIn('::error::', self.plugin.archive_lines[-1])
+        self.assertIn('::error::', self.output[-1])
 
     def test_skipped_status_output(self):
         result = type('Result', (), {
@@ -68,9 +97,9 @@ class TestGithubActionsCallback(unittest.TestCase):
         self.plugin._current_play = 'TestPlay'
         self.plugin._current_task = 'TestTask'
         self.plugin._emit_task_line(result, status='skipped')
-        self.assertNotIn('::notice::', self.plugin.archive_lines[-1])
-        self.assertNotIn('::warning::', self.plugin.archive_lines[-1])
-        self.assertNotIn('::error::', self.plugin.archive_lines[-1])
+        self.assertNotIn('::notice::', self.output[-1])
+        self.assertNotIn('::warning::', self.output[-1])
+        self.assertNotIn('::error::', self.output[-1])
 
     def test_unreachable_status_output(self):
         """Test unreachable status shows ::error:: prefix"""
@@ -81,9 +110,9 @@ class TestGithubActionsCallback(unittest.TestCase):
         self.plugin._current_play = 'TestPlay'
         self.plugin._current_task = 'TestTask'
         self.plugin._emit_task_line(result, status='unreachable')
-        self.assertIn('::error::', self.plugin.archive_lines[-1])
-        self.assertIn('unreachable_host', self.plugin.archive_lines[-1])
-        self.assertIn('unreachable', self.plugin.archive_lines[-1])
+        self.assertIn('::error::', self.output[-1])
+        self.assertIn('unreachable_host', self.output[-1])
+        self.assertIn('unreachable', self.output[-1])
 
     def test_statistics_tracking(self):
         result = type('Result', (), {
@@ -103,18 +132,25 @@ class TestGithubActionsCallback(unittest.TestCase):
         self.assertEqual(self.plugin.stats['plays']['TestPlay']['localhost']['changed'], 1)
 
     def test_archive_file_functionality(self):
-        with tempfile.NamedTemporaryFile(mode='w', delete=False) as tmp:
-            self.plugin.archive_file = tmp.name
-        
-        self.plugin.archive_lines = ['test line 1', 'test line 2']
-        self.plugin._write_archive_file()
-        
-        with open(tmp.name, 'r') as f:
-            content = f.read()
-            self.assertIn('test line 1', content)
-            self.assertIn('test line 2', content)
-        
-        os.unlink(tmp.name)
+        archive_file = os.path.join(tempfile.mkdtemp(), 'archive.log')
+        self.plugin._apply_options(dict(DEFAULT_CONFIG, archive_file=archive_file))
+        self.plugin._emit('test line 1')
+        self.plugin._emit('test line 2')
+        self.plugin.v2_playbook_on_stats(None)
+
+        self.assertIsNone(self.plugin.archive)
+        with open(archive_file, 'r') as f:
+            content = f.read().splitlines()
+        self.assertEqual(content[:2], ['test line 1', 'test line 2'])
+        self.assertEqual(content, self.output)
+
+    def test_archive_disabled_with_empty_archive_file(self):
+        """Test an empty archive_file keeps output on stdout only"""
+        plugin = self.configured_plugin(archive_file='')
+        self.assertIsNone(plugin.archive)
+        plugin._emit('test line')
+        plugin.v2_playbook_on_stats(None)
+        self.assertEqual(self.output[0], 'test line')
 
     def test_verbose_error_output(self):
         self.plugin.verbose = True
@@ -126,13 +162,13 @@ class TestGithubActionsCallback(unittest.TestCase):
         
         self.plugin._current_play = 'TestPlay'
         self.plugin._current_task = 'TestTask'
-        initial_count = len(self.plugin.archive_lines)
+        initial_count = len(self.output)
         
         self.plugin.v2_runner_on_failed(result)
         
         # Should have added the task line plus error details
-        self.assertGreater(len(self.plugin.archive_lines), initial_count + 1)
-        error_lines = [line for line in self.plugin.archive_lines if 'Error details' in line]
+        self.assertGreater(len(self.output), initial_count + 1)
+        error_lines = [line for line in self.output if 'Error details' in line]
         self.assertEqual(len(error_lines), 1)
 
     def test_smart_grouping_single_host(self):
@@ -214,5 +250,764 @@ class TestGithubActionsCallback(unittest.TestCase):
         self.assertEqual(self.plugin.current_grouping, 'task')
         self.assertFalse(self.plugin._play_group_open)
 
+    def test_result_event_extracted_once_for_all_sinks(self):
+        """Test that every sink receives the same immutable result event"""
+        received = []
+        sink = type('Sink', (), {
+            'name': 'test',
+            'handle': lambda self, event: received.append(event),
+            'close': lambda self: None,
+        })
+        self.plugin.sinks = [sink(), sink()]
+        result = type('Result', (), {
+            '_task': type('Task', (), {'get_path': lambda self: 'playbook.yml'})(),
+            '_host': type('Host', (), {'get_name': lambda self: 'localhost'})(),
+            '_result': {'changed': True, 'msg': 'done'}
+        })()
+        self.plugin._current_play = 'TestPlay'
+        self.plugin._current_task = 'TestTask'
+        self.plugin.v2_runner_on_ok(result)
+
+        self.assertEqual(len(received), 2)
+        self.assertIs(received[0], received[1])
+        self.assertEqual(received[0].kind, 'result')
+        self.assertEqual(received[0].status, 'changed')
+        self.assertEqual(received[0].host, 'localhost')
+        with self.assertRaises(AttributeError):
+            received[0].status = 'ok'
+
+    def test_failing_sink_is_disabled(self):
+        """Test that a sink raising an exception is removed without breaking output"""
+        def fail(self, event):
+            raise IOError('disk full')
+        broken = type('Sink', (), {'name': 'broken', 'handle': fail, 'close': lambda self: None})()
+        self.plugin.sinks = [broken]
+        play = type('Play', (), {'get_name': lambda self: 'Test Play'})()
+
+        self.plugin.v2_playbook_on_play_start(play)
+
+        self.assertEqual(self.plugin.sinks, [])
+        self.assertIn('Disabled broken sink', self.output[-1])
+
+    def test_sink_lines_and_summary_sections(self):
+        """Test lines returned by a sink are shown live and its summary is included"""
+        class Counter(EventSink):
+            name = 'counter'
+
+            def __init__(self):
+                self.results = 0
+
+            def handle(self, event):
+                if event.kind == 'result':
+                    self.results += 1
+                    return ['::group::Counted', f'  {event.host}', '::endgroup::']
+
+            def summary(self):
+                return [f'\nCounted: {self.results}']
+
+        self.plugin.grouping_mode = 'task'
+        self.plugin.sinks.append(Counter())
+        play = type('Play', (), {'get_name': lambda self: 'Web'})()
+        task = type('Task', (), {
+            'get_name': lambda self: 'Install',
+            'get_path': lambda self: 'site.yml:3'
+        })()
+        self.plugin.v2_playbook_on_play_start(play)
+        self.plugin.v2_playbook_on_task_start(task, False)
+        self.plugin.v2_runner_on_ok(type('Result', (), {
+            '_task': task, '_host': type('Host', (), {'get_name': lambda self: 'web1'})()})())
+
+        self.assertEqual(self.output[-5:], [
+            '::endgroup::', '::group::Counted', '  web1', '::endgroup::', '::group::Install'])
+        self.plugin.v2_playbook_on_stats(None)
+        self.assertIn('\nCounted: 1', self.output)
+
+    def test_json_and_metrics_sinks(self):
+        """Test JSON lines and metrics sinks write their files at the end of the run"""
+        import json
+        tmpdir = tempfile.mkdtemp()
+        self.plugin.json_file = os.path.join(tmpdir, 'events.jsonl')
+        self.plugin.metrics_file = os.path.join(tmpdir, 'metrics.json')
+        self.plugin.sinks = self.plugin._build_sinks()
+
+        play = type('Play', (), {'get_name': lambda self: 'Test Play'})()
+        task = type('Task', (), {
+            'get_name': lambda self: 'Test Task',
+            'get_path': lambda self: 'test.yml'
+        })()
+        self.plugin.v2_playbook_on_play_start(play)
+        self.plugin.v2_playbook_on_task_start(task, False)
+        for hostname in ('host1', 'host2'):
+            result = type('Result', (), {
+                '_task': task,
+                '_host': type('Host', (), {'get_name': lambda self, n=hostname: n})(),
+            })()
+            self.plugin.v2_runner_on_skipped(result)
+        self.plugin.v2_playbook_on_stats(None)
+
+        with open(self.plugin.json_file) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual([e['event'] for e in events],
+                         ['play_start', 'task_start', 'result', 'result', 'task_end', 'stats'])
+        self.assertEqual(events[2]['host'], 'host1')
+
+        with open(self.plugin.metrics_file) as f:
+            metrics = json.load(f)
+        self.assertEqual(metrics['events']['result'], 2)
+        self.assertEqual(metrics['results'], {'skipped': 2})
+
+    def test_options_loaded_from_environment(self):
+        """Test set_options reads every documented option and rebuilds the sinks"""
+        tmpdir = tempfile.mkdtemp()
+        plugin = self.configured_plugin(
+            verbose='true',
+            grouping='task',
+            output_limit=20,
+            json_file=os.path.join(tmpdir, 'events.jsonl'),
+            metrics_file=os.path.join(tmpdir, 'metrics.json'),
+        )
+        self.assertIs(plugin.verbose, True)
+        self.assertEqual(plugin.grouping_mode, 'task')
+        self.assertEqual(plugin.current_grouping, 'task')
+        self.assertEqual(plugin.output_limit, 20)
+        self.assertEqual(plugin.json_file, os.path.join(tmpdir, 'events.jsonl'))
+        self.assertEqual([sink.name for sink in plugin.sinks[-2:]], ['json', 'metrics'])
+        self.assertEqual(plugin.diff_lines, DEFAULT_CONFIG['diff_lines'])
+
+        play = type('Play', (), {'get_name': lambda self: 'Test Play'})()
+        plugin.v2_playbook_on_play_start(play)
+        plugin.v2_playbook_on_stats(None)
+        self.assertTrue(os.path.exists(os.path.join(tmpdir, 'events.jsonl')))
+        self.assertTrue(os.path.exists(os.path.join(tmpdir, 'metrics.json')))
+
+    def test_options_default_without_plugin_loader(self):
+        """Test set_options falls back to the defaults when no definitions are registered"""
+        self.plugin.set_options()
+        for name, value in DEFAULT_CONFIG.items():
+            attribute = 'grouping_mode' if name == 'grouping' else name
+            self.assertEqual(getattr(self.plugin, attribute), value, name)
+        self.assertEqual([sink.name for sink in self.plugin.sinks],
+                         ['failures', 'stragglers', 'facts', 'context', 'unreachable'])
+
+    def test_result_extraction_truncates_output(self):
+        """Test that only bounded copies of msg/stdout/stderr are kept"""
+        self.plugin.output_limit = 10
+        payload = {'msg': 'm' * 50, 'stdout': 'o' * 50, 'stderr': 'short',
+                   'rc': 2, 'ansible_facts': {'blob': 'x' * 1000}}
+        result = type('Result', (), {
+            '_task': type('Task', (), {'get_path': lambda self: 'playbook.yml'})(),
+            '_host': type('Host', (), {'get_name': lambda self: 'localhost'})(),
+            '_result': payload
+        })()
+        event = self.plugin._extract_result(result, 'failed')
+
+        self.assertEqual(event.msg, 'm' * 10 + '... [truncated 40 chars]')
+        self.assertTrue(event.stdout.startswith('o' * 10 + '...'))
+        self.assertEqual(event.stderr, 'short')
+        self.assertEqual(event.rc, 2)
+        self.assertNotIn(payload, list(event))
+        self.assertNotIn('ansible_facts', event._fields)
+
+    def test_large_payloads_are_not_retained(self):
+        """Test that 5,000 hosts returning 1 MB of facts each do not grow the callback"""
+        import gc
+        import tracemalloc
+        task = type('Task', (), {
+            'get_name': lambda self: 'Gathering Facts',
+            'get_path': lambda self: 'site.yml:1'
+        })()
+        play = type('Play', (), {'get_name': lambda self: 'Fleet'})()
+
+        def run(payload_size):
+            plugin = CallbackModule()
+            plugin._display = type('Display', (), {'display': lambda self, msg: None})()
+            # Rendered lines are streamed to the archive, not kept in memory
+            archive_file = os.path.join(tempfile.mkdtemp(), 'archive.log')
+            plugin._apply_options(dict(DEFAULT_CONFIG, archive_file=archive_file))
+            plugin.v2_playbook_on_play_start(play)
+            plugin.v2_playbook_on_task_start(task, False)
+            gc.collect()
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            for index in range(5000):
+                result = type('Result', (), {
+                    '_task': task,
+                    '_host': type('Host', (), {'get_name': lambda self, n=f'host{index}': n})(),
+                    '_result': {'ansible_facts': {'blob': 'x' * payload_size}, 'msg': 'y' * payload_size},
+                })()
+                plugin.v2_runner_on_ok(result)
+                del result
+            gc.collect()
+            grown = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+            return plugin, grown
+
+        _, baseline = run(0)
+        plugin, grown = run(1024 * 1024)
+
+        self.assertEqual(plugin.stats['totals']['ok'], 5000)
+        self.assertLess(grown - baseline, 1024 * 1024)
+
+    def test_identical_diffs_are_shown_once(self):
+        """Test that the same diff on many hosts is rendered once with a host list"""
+        self.plugin.grouping_mode = 'task'
+        play = type('Play', (), {'get_name': lambda self: 'Drift'})()
+        task = type('Task', (), {
+            'get_name': lambda self: 'Template config',
+            'get_path': lambda self: 'site.yml:3'
+        })()
+        next_task = type('Task', (), {
+            'get_name': lambda self: 'Next',
+            'get_path': lambda self: 'site.yml:9'
+        })()
+        self.plugin.v2_playbook_on_play_start(play)
+        self.plugin.v2_playbook_on_task_start(task, False)
+        for index in range(800):
+            after = 'b\n' if index < 799 else 'c\n'
+            result = type('Result', (), {
+                '_task': task,
+                '_host': type('Host', (), {'get_name': lambda self, n=f'host{index}': n})(),
+                '_result': {'diff': [{'before': 'a\n', 'after': after, 'after_header': '/etc/app.conf'}]},
+            })()
+            self.plugin.v2_on_file_diff(result)
+        self.plugin.v2_playbook_on_task_start(next_task, False)
+
+        headers = [line for line in self.output if line.startswith('Diff (')]
+        self.assertEqual(len(headers), 2)
+        self.assertTrue(headers[0].startswith('Diff (799 hosts): host0, host1'))
+        self.assertTrue(headers[0].endswith('(+779 more)'))
+        self.assertEqual(headers[1], 'Diff (1 host): host799')
+        self.assertEqual(self.output.count('+b'), 1)
+        # Diffs are shown inside the task group, before it is closed
+        self.assertEqual(self.output[-3:-1], ['+c', '::endgroup::'])
+
+    def test_diff_truncated_to_line_budget(self):
+        """Test that long diffs are cut to the configured number of lines"""
+        self.plugin.diff_lines = 5
+        result = type('Result', (), {
+            '_task': type('Task', (), {'get_path': lambda self: 'playbook.yml'})(),
+            '_host': type('Host', (), {'get_name': lambda self: 'localhost'})(),
+            '_result': {'diff': {'before': '', 'after': ''.join(f'line{i}\n' for i in range(100))}},
+        })()
+        self.plugin.v2_on_file_diff(result)
+        self.plugin._flush_diffs()
+
+        self.assertEqual(self.output[0], 'Diff (1 host): localhost')
+        self.assertEqual(len(self.output), 7)
+        self.assertIn('diff truncated, 98 more lines', self.output[-1])
+
+    def test_check_mode_marker_in_summary(self):
+        """Test that the summary states when tasks ran in check mode"""
+        task = type('Task', (), {
+            'get_name': lambda self: 'Check task',
+            'get_path': lambda self: 'test.yml',
+            'check_mode': True
+        })()
+        self.plugin.v2_playbook_on_task_start(task, False)
+        self.plugin.v2_playbook_on_stats(None)
+
+        marker = [line for line in self.output if line.startswith('Check mode:')]
+        self.assertEqual(len(marker), 1)
+        self.assertIn('1 task ran in check mode', marker[0])
+
+    def test_handler_results_attributed_to_handler(self):
+        """Test that handler results are counted against the handler, not the last task"""
+        self.plugin.grouping_mode = 'task'
+        play = type('Play', (), {'get_name': lambda self: 'Web'})()
+        task = type('Task', (), {
+            'get_name': lambda self: 'Template config',
+            'get_path': lambda self: 'site.yml:3',
+            '_uuid': 'task-1'
+        })()
+        handler = type('Task', (), {
+            'get_name': lambda self: 'restart nginx',
+            'get_path': lambda self: 'site.yml:9',
+            '_uuid': 'handler-1'
+        })()
+
+        def result(task_obj, hostname):
+            return type('Result', (), {
+                '_task': task_obj,
+                '_host': type('Host', (), {'get_name': lambda self: hostname})(),
+                '_result': {'changed': True},
+            })()
+
+        self.plugin.v2_playbook_on_play_start(play)
+        self.plugin.v2_playbook_on_task_start(task, False)
+        self.plugin.v2_runner_on_ok(result(task, 'web1'))
+        self.plugin.v2_playbook_on_handler_task_start(handler)
+        self.assertIn('::group::Handler: restart nginx', self.output)
+        self.plugin.v2_runner_on_ok(result(handler, 'web1'))
+        self.plugin.v2_runner_on_ok(result(handler, 'web2'))
+        # A late result of the task still belongs to the task
+        self.plugin.v2_runner_on_ok(result(task, 'web2'))
+
+        tasks = self.plugin.stats['tasks']
+        self.assertEqual(tasks['task-1']['changed'], 2)
+        self.assertEqual(tasks['handler-1']['changed'], 2)
+        self.assertTrue(tasks['handler-1']['handler'])
+        self.assertIn('| Handler: restart nginx', self.output[-2])
+        self.assertIn('| Template config', self.output[-1])
+
+    def test_include_and_no_hosts_events(self):
+        """Test include lines and group handling when no hosts are left"""
+        self.plugin.grouping_mode = 'task'
+        play = type('Play', (), {'get_name': lambda self: 'Web'})()
+        task = type('Task', (), {
+            'get_name': lambda self: 'Include',
+            'get_path': lambda self: 'site.yml:3'
+        })()
+        included = type('IncludedFile', (), {
+            '_filename': 'tasks/extra.yml',
+            '_hosts': [type('Host', (), {'get_name': lambda self: 'web1'})()],
+        })()
+        self.plugin.v2_playbook_on_play_start(play)
+        self.plugin.v2_playbook_on_task_start(task, False)
+        self.plugin.v2_playbook_on_include(included)
+        self.assertEqual(self.output[-1], 'included: tasks/extra.yml for web1')
+
+        self.plugin.v2_playbook_on_no_hosts_remaining()
+        self.assertFalse(self.plugin._task_group_open)
+        self.assertEqual(self.output[-2:],
+                         ['::endgroup::', '::error::No more hosts left in play: Web'])
+
+        self.plugin.v2_playbook_on_no_hosts_matched()
+        self.assertIn('No hosts matched', self.output[-1])
+
+    def test_early_failure_warning(self):
+        """Test that crossing the failure threshold emits one early error and a marker file"""
+        import json
+        marker_file = os.path.join(tempfile.mkdtemp(), 'failed.json')
+        self.plugin = self.configured_plugin(
+            fail_threshold=0.5, fail_min_hosts=4, fail_marker_file=marker_file)
+        self.assertEqual(self.plugin.failure_monitor.threshold, 0.5)
+        self.assertEqual(self.plugin.failure_monitor.min_hosts, 4)
+        self.plugin._current_play = 'Deploy'
+        self.plugin._current_task = 'Migrate'
+
+        def result(hostname):
+            return type('Result', (), {
+                '_task': type('Task', (), {'get_path': lambda self: 'site.yml:3'})(),
+                '_host': type('Host', (), {'get_name': lambda self: hostname})(),
+            })()
+
+        self.plugin.v2_runner_on_ok(result('host1'))
+        self.plugin.v2_runner_on_failed(result('host2'))
+        self.plugin.v2_runner_on_failed(result('host3'), ignore_errors=True)
+        self.assertFalse(os.path.exists(self.plugin.fail_marker_file))
+        self.plugin.v2_runner_on_unreachable(result('host4'))
+        self.plugin.v2_runner_on_failed(result('host5'))
+
+        warnings = [line for line in self.output if 'Early failure warning' in line]
+        self.assertEqual(warnings, [
+            "::error::Early failure warning: task 'Migrate' failed on 2/4 hosts (50%, threshold 50%)"
+        ])
+        with open(self.plugin.fail_marker_file) as f:
+            marker = json.load(f)
+        self.assertEqual(marker['scope'], 'task')
+        self.assertEqual(marker['failures'], 2)
+
+    def test_early_failure_warning_when_failures_arrive_first(self):
+        """Test the rate is checked when ok results push the count past fail_min_hosts"""
+        self.plugin = self.configured_plugin(fail_threshold=0.5, fail_min_hosts=10)
+        self.plugin._current_play = 'Deploy'
+        self.plugin._current_task = 'Migrate'
+
+        def result(hostname):
+            return type('Result', (), {
+                '_task': type('Task', (), {'get_path': lambda self: 'site.yml:3'})(),
+                '_host': type('Host', (), {'get_name': lambda self: hostname})(),
+            })()
+
+        for index in range(6):
+            self.plugin.v2_runner_on_failed(result(f'bad{index}'))
+        for index in range(3):
+            self.plugin.v2_runner_on_ok(result(f'good{index}'))
+        self.assertIsNone(self.plugin.failure_monitor.breach)
+        self.plugin.v2_runner_on_ok(result('good3'))
+
+        breach = self.plugin.failure_monitor.breach
+        self.assertEqual((breach['failures'], breach['total']), (6, 10))
+        self.assertEqual(self.output[-1],
+                         "::error::Early failure warning: task 'Migrate' failed on 6/10 hosts (60%, threshold 50%)")
+
+    def test_early_failure_warning_disabled_by_default(self):
+        """Test that no early warning is emitted without a threshold"""
+        self.plugin._current_task = 'Migrate'
+        result = type('Result', (), {
+            '_task': type('Task', (), {'get_path': lambda self: 'site.yml:3'})(),
+            '_host': type('Host', (), {'get_name': lambda self: 'host1'})(),
+        })()
+        for _ in range(20):
+            self.plugin.v2_runner_on_failed(result)
+        self.assertFalse(any('Early failure' in line for line in self.output))
+
+    def test_unreachable_classification(self):
+        """Test connection failure messages are mapped to categories"""
+        cases = {
+            'Failed to connect to the host via ssh: ssh: Could not resolve hostname web1: Name or service not known': 'dns',
+            'Failed to connect to the host via ssh: ssh: connect to host 10.0.0.1 port 22: Connection timed out': 'timeout',
+            'Failed to connect to the host via ssh: deploy@10.0.0.1: Permission denied (publickey).': 'auth',
+            'Failed to connect to the host via ssh: connect to host 10.0.0.1 port 22: Connection refused': 'refused',
+            'Host key verification failed.': 'host_key',
+            'Data could not be sent to remote host': 'other',
+            None: 'other',
+        }
+        for msg, category in cases.items():
+            self.assertEqual(classify_unreachable(msg), category, msg)
+
+    def test_unreachable_summary_and_retry_file(self):
+        """Test unreachable hosts are tracked once with their first failing task"""
+        tmpdir = tempfile.mkdtemp()
+        self.plugin = self.configured_plugin(retry_file=os.path.join(tmpdir, 'retry.txt'))
+        self.plugin._current_play = 'Deploy'
+
+        def unreachable(hostname, msg):
+            return type('Result', (), {
+                '_task': type('Task', (), {'get_path': lambda self: 'site.yml:3'})(),
+                '_host': type('Host', (), {'get_name': lambda self: hostname})(),
+                '_result': {'msg': msg, 'unreachable': True},
+            })()
+
+        self.plugin._current_task = 'Gathering Facts'
+        for index in range(7):
+            self.plugin.v2_runner_on_unreachable(unreachable(f'web{index}', 'Connection timed out'))
+        self.plugin._current_task = 'Install'
+        self.plugin.v2_runner_on_unreachable(unreachable('db1', 'Could not resolve hostname db1'))
+        self.plugin.v2_runner_on_unreachable(unreachable('web0', 'Permission denied'))
+        self.plugin.v2_playbook_on_stats(None)
+
+        self.assertEqual(self.plugin.unreachable.hosts['web0']['task'], 'Gathering Facts')
+        self.assertEqual(self.plugin.unreachable.hosts['web0']['category'], 'timeout')
+        self.assertIn('\nUnreachable hosts: 8', self.output)
+        rows = [line for line in self.output if line.startswith('  timeout') or line.startswith('  dns')]
+        self.assertEqual(len(rows), 2)
+        self.assertIn('7  Deploy | Gathering Facts', rows[0])
+        self.assertIn('(+2 more)', rows[0])
+        self.assertIn('Deploy | Install  [db1]', rows[1])
+        with open(self.plugin.retry_file) as f:
+            self.assertEqual(f.read().split(), ['db1'] + [f'web{i}' for i in range(7)])
+
+    def test_streaming_median_estimate(self):
+        """Test the P-square estimate stays close to the true median"""
+        import random
+        rng = random.Random(42)
+        samples = [rng.expovariate(1.0) for _ in range(10000)]
+        estimate = StreamingQuantile(0.5)
+        for value in samples:
+            estimate.add(value)
+        true_median = sorted(samples)[len(samples) // 2]
+        self.assertAlmostEqual(estimate.value(), true_median, delta=true_median * 0.05)
+        self.assertEqual(len(estimate._heights), 5)
+
+        small = StreamingQuantile(0.5)
+        for value in (3, 1, 2):
+            small.add(value)
+        self.assertEqual(small.value(), 2)
+
+    def test_straggler_detection(self):
+        """Test that a slow host is annotated once and listed in the summary"""
+        import time
+        self.plugin.grouping_mode = 'task'
+        play = type('Play', (), {'get_name': lambda self: 'Deploy'})()
+        task = type('Task', (), {
+            'get_name': lambda self: 'Install packages',
+            'get_path': lambda self: 'site.yml:3'
+        })()
+        self.plugin.v2_playbook_on_play_start(play)
+        self.plugin.v2_playbook_on_task_start(task, False)
+
+        arrivals = [('host%d' % i, 2.0 + i * 0.1) for i in range(10)]
+        arrivals += [('slow1', 30.0), ('slow2', 40.0)]
+        for hostname, seconds in arrivals:
+            self.plugin._task_started = time.monotonic() - seconds
+            result = type('Result', (), {
+                '_task': task,
+                '_host': type('Host', (), {'get_name': lambda self, n=hostname: n})(),
+            })()
+            self.plugin.v2_runner_on_ok(result)
+        self.plugin.v2_playbook_on_stats(None)
+
+        annotations = [line for line in self.output if line.startswith('::warning::Straggler')]
+        self.assertEqual(len(annotations), 1)
+        self.assertIn('slow1', annotations[0])
+        self.assertEqual([s['host'] for s in self.plugin.straggler_detector.worst()], ['slow2', 'slow1'])
+        self.assertIn('\nStragglers: 2', self.output)
+
+    def test_stragglers_kept_in_bounded_memory(self):
+        """Test only the worst stragglers are kept while all of them are counted"""
+        detector = StragglerDetector(3.0, 5)
+        detector.start_task('task1')
+
+        def event(hostname, duration):
+            return type('Event', (), {
+                'kind': 'result', 'status': 'ok', 'host': hostname, 'play': 'Deploy',
+                'task': 'Install', 'task_id': 'task1', 'elapsed': duration,
+            })()
+
+        for index in range(1000):
+            detector.handle(event(f'host{index}', 1.0))
+        for index in range(STRAGGLERS_SHOWN * 5):
+            detector.handle(event(f'slow{index}', 10.0 + index))
+
+        worst = detector.worst()
+        self.assertEqual(detector.count, STRAGGLERS_SHOWN * 5)
+        self.assertEqual(len(worst), STRAGGLERS_SHOWN)
+        ratios = [s['elapsed'] / s['median'] for s in worst]
+        self.assertEqual(ratios, sorted(ratios, reverse=True))
+        self.assertGreater(ratios[-1], 10.0 + STRAGGLERS_SHOWN * 3)
+        self.assertEqual(detector.summary()[0], f'\nStragglers: {STRAGGLERS_SHOWN * 5}')
+        self.assertEqual(len(detector.summary()), STRAGGLERS_SHOWN + 1)
+
+    def test_skipped_and_unreachable_results_are_not_stragglers(self):
+        """Test fast skipped hosts do not turn every host that runs the task into a straggler"""
+        detector = StragglerDetector(3.0, 5)
+        detector.start_task('task1')
+
+        def event(hostname, status, duration):
+            return type('Event', (), {
+                'kind': 'result', 'status': status, 'host': hostname, 'play': 'Deploy',
+                'task': 'Install', 'task_id': 'task1', 'elapsed': duration,
+            })()
+
+        for index in range(20):
+            detector.handle(event(f'skip{index}', 'skipped', 0.05))
+        detector.handle(event('gone', 'unreachable', 30.0))
+        for index in range(5):
+            self.assertIsNone(detector.handle(event(f'run{index}', 'ok', 4.0)))
+        detector.handle(event('slow', 'changed', 40.0))
+
+        self.assertEqual(detector.count, 1)
+        self.assertEqual([s['host'] for s in detector.worst()], ['slow'])
+        self.assertEqual(detector.worst()[0]['median'], 4.0)
+
+    def test_role_and_file_rollup(self):
+        """Test results and task time are rolled up per role and per task file"""
+        role = type('Role', (), {'get_name': lambda self: 'nginx'})()
+        role_task = type('Task', (), {
+            'get_name': lambda self: 'nginx : Install',
+            'get_path': lambda self: '/srv/roles/nginx/tasks/main.yml:4',
+            '_role': role,
+            '_uuid': 'role-task'
+        })()
+        play_task = type('Task', (), {
+            'get_name': lambda self: 'Ping',
+            'get_path': lambda self: '/srv/site.yml:12',
+            '_role': None,
+            '_uuid': 'play-task'
+        })()
+        host = type('Host', (), {'get_name': lambda self: 'web1'})()
+        self.plugin._current_play = 'Web'
+
+        self.plugin.v2_playbook_on_task_start(role_task, False)
+        self.plugin.v2_runner_on_ok(type('Result', (), {
+            '_task': role_task, '_host': host, '_result': {'changed': True}})())
+        self.plugin.v2_playbook_on_task_start(play_task, False)
+        self.plugin.v2_runner_on_failed(type('Result', (), {'_task': play_task, '_host': host})())
+        self.plugin.v2_playbook_on_stats(None)
+
+        rollup = self.plugin.stats['rollup']
+        self.assertEqual(set(rollup['roles']), {'nginx', '(no role)'})
+        self.assertEqual(rollup['roles']['nginx']['changed'], 1)
+        self.assertEqual(rollup['roles']['nginx']['tasks'], 1)
+        self.assertEqual(rollup['files']['/srv/site.yml']['failed'], 1)
+        self.assertGreater(rollup['files']['/srv/roles/nginx/tasks/main.yml']['duration'], 0)
+        self.assertIn('\nRoles:', self.output)
+        self.assertIn('\nTask files:', self.output)
+
+    def test_fact_gathering_report(self):
+        """Test gathering time is each host's own run time, kept per play"""
+        import time
+
+        def gather_task(uuid):
+            return type('Task', (), {
+                'get_name': lambda self: 'Gathering Facts',
+                'get_path': lambda self: 'site.yml:1',
+                'action': 'ansible.builtin.gather_facts',
+                '_uuid': uuid
+            })()
+
+        other = type('Task', (), {
+            'get_name': lambda self: 'Ping',
+            'get_path': lambda self: 'site.yml:5',
+            'action': 'ping',
+            '_uuid': 'ping'
+        })()
+
+        def host(hostname):
+            return type('Host', (), {'get_name': lambda self: hostname})()
+
+        def run(task, hostname, seconds, payload=None):
+            started = time.monotonic()
+            with mock.patch('time.monotonic', return_value=started):
+                self.plugin.v2_runner_on_start(host(hostname), task)
+            result = type('Result', (), {'_task': task, '_host': host(hostname), '_result': payload or {}})()
+            with mock.patch('time.monotonic', return_value=started + seconds):
+                if payload:
+                    self.plugin.v2_runner_on_failed(result)
+                else:
+                    self.plugin.v2_runner_on_ok(result)
+
+        timeout = {'msg': 'Gathering facts timed out'}
+        self.plugin.v2_playbook_on_play_start(type('Play', (), {'get_name': lambda self: 'Fleet'})())
+        gather = gather_task('gather')
+        self.plugin.v2_playbook_on_task_start(gather, False)
+        # Waiting for a fork is not part of a host's gathering time
+        self.plugin._task_started = time.monotonic() - 60
+        received = []
+        self.plugin.sinks.append(type('Sink', (EventSink,), {'handle': lambda self, event: received.append(event)})())
+        for index, seconds in enumerate([1.0, 2.0, 3.0, 9.0, 4.0, 5.0, 6.0]):
+            run(gather, f'host{index}', seconds)
+        run(gather, 'slowdb', 10.0, timeout)
+        self.plugin.v2_playbook_on_task_start(other, False)
+        self.plugin.v2_runner_on_start(host('host0'), other)
+        self.plugin.v2_runner_on_ok(type('Result', (), {'_task': other, '_host': host('host0')})())
+
+        # The same hosts gather facts again in a second play, twice for slowdb
+        self.plugin.v2_playbook_on_play_start(type('Play', (), {'get_name': lambda self: 'Again'})())
+        for uuid in ('gather2', 'gather3'):
+            gather = gather_task(uuid)
+            self.plugin.v2_playbook_on_task_start(gather, False)
+            run(gather, 'host0', 1.0)
+            run(gather, 'slowdb', 10.0, timeout)
+        self.plugin.v2_playbook_on_stats(None)
+
+        first = [event for event in received if event.kind == 'result'][0]
+        self.assertEqual(first.duration, 1.0)
+        self.assertGreaterEqual(first.elapsed, 60.0)
+
+        report = self.plugin.fact_report
+        self.assertNotIn('ping', report.tasks)
+        self.assertEqual(self.plugin._host_started, {})
+        fleet, again = report.plays['Fleet'], report.plays['Again']
+        self.assertEqual(len(fleet['hosts']), 8)
+        self.assertEqual(fleet['hosts']['host3'], 9.0)
+        self.assertEqual(again['hosts'], {'host0': 2.0, 'slowdb': 20.0})
+        self.assertEqual(list(again['timed_out']), ['slowdb'])
+        self.assertGreater(fleet['duration'], 0)
+        self.assertEqual(report.slowest()[0][1:], ('slowdb', 'Again'))
+        self.assertEqual(len(list(report.samples())), 10)
+        self.assertIn('\nFact gathering: 8 hosts, median 4.50s, max 20.00s', self.output)
+        self.assertIn('  Play Again: ', ''.join(self.output))
+        self.assertIn('  Timed out (1): slowdb', self.output)
+
+    def test_sampling_hides_only_ok_and_skipped_lines(self):
+        """Test deterministic sampling keeps statistics exact and always shows changes"""
+        self.plugin = self.configured_plugin(sample_rate=0.25)
+        self.assertEqual(self.plugin.sample_rate, 0.25)
+        self.plugin._current_play = 'Nightly'
+        self.plugin._current_task = 'Check config'
+        hosts = [f'node{i:04d}' for i in range(400)]
+        sampled = [h for h in hosts if host_in_sample(h, 0.25)]
+        self.assertTrue(50 < len(sampled) < 150)
+        self.assertEqual(sampled, [h for h in hosts if host_in_sample(h, 0.25)])
+
+        for hostname in hosts:
+            result = type('Result', (), {
+                '_task': type('Task', (), {'get_path': lambda self: 'site.yml:3'})(),
+                '_host': type('Host', (), {'get_name': lambda self, n=hostname: n})(),
+            })()
+            self.plugin.v2_runner_on_ok(result)
+            self.plugin.v2_runner_on_skipped(result)
+        self.plugin.v2_runner_on_changed(result)
+        self.plugin.v2_playbook_on_stats(None)
+
+        ok_lines = [line for line in self.output if line.startswith('::notice::site.yml')]
+        self.assertEqual(len(ok_lines), len(sampled))
+        self.assertIn(f'| {hosts[-1]} | changed |', ''.join(self.output))
+        self.assertEqual(self.plugin.stats['totals']['ok'], 400)
+        self.assertEqual(self.plugin.stats['totals']['skipped'], 400)
+        summary = [line for line in self.output if line.startswith('Sampling:')]
+        self.assertEqual(len(summary), 1)
+        self.assertIn('25% of hosts', summary[0])
+        self.assertIn(f'({2 * (400 - len(sampled))} lines omitted', summary[0])
+
+    def test_host_context_buffer_is_bounded(self):
+        """Test per-host ring buffers keep N lines and evict the least recent host"""
+        buffer = HostContextBuffer(3, 2)
+
+        def event(hostname, task, status='ok', msg=''):
+            return type('Event', (), {
+                'host': hostname, 'play': 'Web', 'task': task, 'status': status,
+                'duration': 0.5, 'rc': None, 'msg': msg,
+            })()
+
+        for index in range(5):
+            buffer.record(event('web1', f'task{index}'))
+        buffer.record(event('web2', 'task0'))
+        buffer.record(event('web1', 'task5'))
+        buffer.record(event('web3', 'task0', 'failed', 'x' * 1000))
+
+        self.assertEqual(len(buffer), 2)
+        self.assertEqual(buffer.lines('web2'), [])
+        self.assertEqual([line.split(' | ')[2] for line in buffer.lines('web1')],
+                         ['task3', 'task4', 'task5'])
+        self.assertLess(len(buffer.lines('web3')[0]), 300)
+
+    def test_host_context_dumped_after_failure(self):
+        """Test a failing host's recent results are shown in their own group"""
+        self.plugin.grouping_mode = 'task'
+        play = type('Play', (), {'get_name': lambda self: 'Web'})()
+        host = type('Host', (), {'get_name': lambda self: 'web1'})()
+        self.plugin.v2_playbook_on_play_start(play)
+        for name in ('Install', 'Configure', 'Start'):
+            task = type('Task', (), {
+                'get_name': lambda self, n=name: n,
+                'get_path': lambda self: 'site.yml:3'
+            })()
+            self.plugin.v2_playbook_on_task_start(task, False)
+            if name != 'Start':
+                self.plugin.v2_runner_on_ok(type('Result', (), {'_task': task, '_host': host})())
+        self.plugin.v2_runner_on_failed(type('Result', (), {
+            '_task': task, '_host': host, '_result': {'msg': 'service failed', 'rc': 1}})())
+
+        tail = self.output[-7:]
+        self.assertEqual(tail[0], '::endgroup::')
+        self.assertEqual(tail[1], '::group::Context: web1 (last 3 results)')
+        self.assertEqual(tail[2], '  ok | Web | Install | 0.0s')
+        self.assertEqual(tail[4], '  failed | Web | Start | 0.0s | rc=1 | service failed')
+        self.assertEqual(tail[5:], ['::endgroup::', '::group::Start'])
+        self.assertTrue(self.plugin._task_group_open)
+
+        # Failures with ignore_errors do not dump context
+        count = len(self.output)
+        self.plugin.v2_runner_on_failed(type('Result', (), {'_task': task, '_host': host})(), ignore_errors=True)
+        self.assertEqual(len(self.output), count + 1)
+
+    def test_host_context_dumps_limited_per_task(self):
+        """Test context is skipped without earlier results and capped per task"""
+        self.plugin.grouping_mode = 'task'
+        self.plugin.v2_playbook_on_play_start(type('Play', (), {'get_name': lambda self: 'Web'})())
+
+        def task(name):
+            return type('Task', (), {
+                'get_name': lambda self: name,
+                'get_path': lambda self: 'site.yml:3'
+            })()
+
+        def result(task, hostname):
+            return type('Result', (), {
+                '_task': task,
+                '_host': type('Host', (), {'get_name': lambda self: hostname})(),
+                '_result': {'msg': 'failed'},
+            })()
+
+        install, start = task('Install'), task('Start')
+        self.plugin.v2_playbook_on_task_start(install, False)
+        for index in range(CONTEXT_HOSTS_SHOWN + 3):
+            self.plugin.v2_runner_on_ok(result(install, f'web{index}'))
+        self.plugin.v2_playbook_on_task_start(start, False)
+        self.plugin.v2_runner_on_failed(result(start, 'fresh'))
+        for index in range(CONTEXT_HOSTS_SHOWN + 3):
+            self.plugin.v2_runner_on_failed(result(start, f'web{index}'))
+        self.plugin.v2_playbook_on_task_start(task('Cleanup'), False)
+
+        lines = self.output
+        groups = [line for line in lines if line.startswith('::group::Context:')]
+        self.assertEqual(len(groups), CONTEXT_HOSTS_SHOWN)
+        self.assertFalse(any('fresh' in line for line in groups))
+        self.assertEqual(lines[-3:], [
+            'Context omitted for 3 more failing hosts', '::endgroup::', '::group::Cleanup'])
+
 if __name__ == '__main__':
     unittest.main()
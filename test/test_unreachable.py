@@ -28,6 +28,13 @@ class MockTask:
     def get_path(self):
         return self.path
 
+class MockDisplay:
+    def __init__(self):
+        self.lines = []
+
+    def display(self, msg):
+        self.lines.append(msg)
+
 class MockResult:
     def __init__(self, host, task, result_data=None):
         self._host = host
@@ -44,6 +51,8 @@ def test_status_formatting():
     
     plugin = CallbackModule()
     plugin.set_options()
+    plugin._display = MockDisplay()
+    plugin.archive = None  # Output is only shown, no archive file is written
     
     # Create mock objects
     host1 = MockHost("test_host1")
@@ -76,8 +85,8 @@ def test_status_formatting():
         plugin._emit_task_line(result, status)
         
         # Show the last line that was added
-        if plugin.archive_lines:
-            print(f"  Output: {plugin.archive_lines[-1]}")
+        if plugin._display.lines:
+            print(f"  Output: {plugin._display.lines[-1]}")
 
 def main():
     test_status_formatting()